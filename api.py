@@ -0,0 +1,352 @@
+"""REST interface for the application, served with `uvicorn api:app`."""
+import codecs
+import csv
+import json
+import locale
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterator, Optional, List, Sequence, Tuple, Union
+
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.openapi.utils import get_openapi
+from pydantic.main import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+from domain import metrics
+from domain.record import PARSE_ERRORS, parse_key_columns
+from domain.storage import MmapBackend
+from domain.store import RecordStore
+from models.record import RecordFileType, Record
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Persist the store's indexes on shutdown, so the next start maps them instead of indexing records again."""
+    yield
+    await run_in_threadpool(web_records.persist_indexes)
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Hot path metrics, served on /metrics, are only collected when RECORDS_METRICS is set to something other than 0
+if os.environ.get('RECORDS_METRICS', '0') != '0':
+    metrics.enable()
+
+# Holds records for the duration this API instance's lifetime, or persistently in the directory named by
+# RECORDS_STORE_PATH, which restarts and other worker processes share. Sorts compare strings in the RECORDS_COLLATION
+# collation, code point order by default. Records can be upserted by the key columns in RECORDS_KEY, such as 2 for the
+# email, when it is set.
+store_path = os.environ.get('RECORDS_STORE_PATH')
+store_collation = os.environ.get('RECORDS_COLLATION', 'ordinal')
+if store_collation == 'locale':
+    locale.setlocale(locale.LC_COLLATE, '')
+store_key = parse_key_columns(os.environ['RECORDS_KEY']) if os.environ.get('RECORDS_KEY') else None
+web_records = RecordStore(MmapBackend(store_path) if store_path else None, collation=store_collation,
+                          key_columns=store_key)
+
+
+# Methods requests are labelled by in metrics, any other token a client sends is labelled other
+HTTP_METHODS = frozenset(['GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'CONNECT', 'OPTIONS', 'TRACE', 'PATCH'])
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware timing every HTTP request by method, route and status when metrics are enabled."""
+
+    def __init__(self, app):
+        """Wrap an ASGI application."""
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        """Pass a connection on to the application, timing it through to the last byte of the response."""
+        if scope['type'] != 'http' or not metrics.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router leaves the matched route in the scope, its path template keeps label values bounded
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            method = scope['method'] if scope['method'] in HTTP_METHODS else 'other'
+            metrics.observe('records_http_request_duration_seconds', time.perf_counter() - start,
+                            method=method, route=route, status=status)
+
+
+app.add_middleware(RequestMetricsMiddleware)
+
+
+UPSERT_QUERY = Query(False, description="Replace stored records with the same key instead of adding duplicates. "
+                                        "Needs the API to run with RECORDS_KEY set.")
+UPSERT_DESCRIPTION = " With upsert, a stored record with the same key is replaced in place instead."
+
+
+def _upsert(records: List[Record]) -> Tuple[int, int]:
+    """Upsert records into the store, returning (inserted, replaced), responding 400 when it can't upsert."""
+    try:
+        return web_records.upsert_many(records)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="upserts need RECORDS_KEY and in-memory storage")
+
+
+class CreateRecordRequestModel(BaseModel):
+    """Pydantic request model for adding a Record."""
+
+    record: str
+    fmt: Optional[str] = "csv"
+
+
+@app.post('/records',
+          status_code=201,
+          response_model=List[str],
+          operation_id="create_record",
+          summary="Create a record",
+          description="Create a record and save in-memory for the lifetime of this API instance. "
+                      "Provide last name, first name, email, color, and date of birth respectively. "
+                      "Separate values using the separator specified in fmt. csv:, psv:|, ssv: ." + UPSERT_DESCRIPTION)
+async def add_record(request: CreateRecordRequestModel, response: Response,
+                     upsert: bool = UPSERT_QUERY) -> List[str]:
+    """Handle adding a Record to Record storage."""
+    if request.fmt not in ['csv', 'psv', 'ssv']:
+        raise HTTPException(status_code=422, detail="unsupported record format")
+
+    try:
+        delimiter = RecordFileType.delimiters[RecordFileType(request.fmt)]
+        record = [Record(*row) for row in csv.reader([request.record], delimiter=delimiter)][0]
+    except PARSE_ERRORS:
+        metrics.count('records_parse_errors_total', source='api')
+        raise HTTPException(status_code=422, detail="record syntax invalid, failed to parse")
+    metrics.count('records_parsed_total', format=request.fmt)
+    if not upsert:
+        await run_in_threadpool(web_records.add, record)
+    elif await run_in_threadpool(_upsert, [record]) == (0, 1):
+        response.status_code = 200
+    return record.as_list()
+
+
+class BulkRecordErrorModel(BaseModel):
+    """Pydantic model for a line of a bulk upload that could not be stored."""
+
+    line: int
+    detail: str
+
+
+class BulkCreateRecordsResponseModel(BaseModel):
+    """Pydantic response model for a bulk upload of records."""
+
+    inserted: int
+    replaced: int = 0
+    failed: int
+    errors: List[BulkRecordErrorModel]
+
+
+# Failed lines reported individually in a bulk upload response, the failed count covers the rest
+MAX_BULK_ERRORS = 1000
+
+
+async def _body_lines(request: Request) -> AsyncIterator[str]:
+    """Incrementally decode a streamed request body and yield its lines."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    async for chunk in request.stream():
+        *lines, pending = (pending + decoder.decode(chunk)).split('\n')
+        for line in lines:
+            yield line
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+@app.post('/records/bulk',
+          status_code=201,
+          response_model=BulkCreateRecordsResponseModel,
+          operation_id="create_records_bulk",
+          summary="Create many records",
+          description="Create records from a request body holding one record per line and save them in-memory for "
+                      "the lifetime of this API instance. Values are separated using the separator specified in fmt. "
+                      "csv:, psv:|, ssv: . The body is parsed as it streams in, every valid line is stored at once "
+                      "after the whole body is read, and lines that fail to parse are reported by line number." +
+                      UPSERT_DESCRIPTION,
+          openapi_extra={'requestBody': {'required': True,
+                                         'content': {'text/plain': {'schema': {'type': 'string'}}}}})
+async def add_records_bulk(request: Request, fmt: str = Query("csv"),
+                           upsert: bool = UPSERT_QUERY) -> BulkCreateRecordsResponseModel:
+    """Handle adding a batch of Records to Record storage."""
+    if fmt not in ['csv', 'psv', 'ssv']:
+        raise HTTPException(status_code=422, detail="unsupported record format")
+    delimiter = RecordFileType.delimiters[RecordFileType(fmt)]
+
+    batch, errors, failed, line_number = [], [], 0, 0
+    try:
+        async for line in _body_lines(request):
+            line_number += 1
+            try:
+                batch += [Record(*row) for row in csv.reader([line.rstrip('\r')], delimiter=delimiter)]
+            except PARSE_ERRORS as e:
+                failed += 1
+                if len(errors) < MAX_BULK_ERRORS:
+                    # Fixed details, exception messages aren't meant for clients. Only dates raise value errors.
+                    invalid_date = isinstance(e, (ValueError, OverflowError))
+                    detail = "date of birth invalid, failed to parse" if invalid_date else \
+                        "record syntax invalid, failed to parse"
+                    errors.append(BulkRecordErrorModel(line=line_number, detail=detail))
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=422, detail="request body is not valid utf-8")
+
+    metrics.count('records_parsed_total', len(batch), format=fmt)
+    metrics.count('records_parse_errors_total', failed, source='bulk')
+    if upsert:
+        inserted, replaced = await run_in_threadpool(_upsert, batch)
+        return BulkCreateRecordsResponseModel(inserted=inserted, replaced=replaced, failed=failed, errors=errors)
+    await run_in_threadpool(web_records.extend, batch)
+    return BulkCreateRecordsResponseModel(inserted=len(batch), failed=failed, errors=errors)
+
+
+# Records serialized per chunk when streaming newline delimited JSON
+STREAM_BATCH_SIZE = 1000
+
+OFFSET_QUERY = Query(0, ge=0, description="Number of sorted records to skip.")
+LIMIT_QUERY = Query(None, ge=0, description="Maximum number of records to return, all remaining if omitted.")
+STREAM_QUERY = Query(False, description="Stream records as newline delimited JSON, one record array per line, "
+                                        "instead of a single JSON array.")
+FILTER_QUERY = Query(None, alias='filter',
+                     description="Only return records matching every filter, formatted as "
+                                 "[column number],[operator],[value]. Operators are eq, prefix, lt, le, gt and ge. "
+                                 "Example: 3,eq,Tan or 4,lt,1/1/1970.")
+PAGE_DESCRIPTION = " Page with offset and limit, the X-Total-Count header holds the number of matching records. " \
+                   "Set stream to receive newline delimited JSON without buffering the whole response."
+
+
+def _ndjson_lines(records: Sequence[Record]) -> Iterator[str]:
+    """Serialize records as newline delimited JSON, reading and sending a batch of records per chunk."""
+    for start in range(0, len(records), STREAM_BATCH_SIZE):
+        yield ''.join(json.dumps(r.as_list()) + '\n' for r in records[start:start + STREAM_BATCH_SIZE])
+
+
+def _record_lists(records: Sequence[Record]) -> List[List[str]]:
+    """Read a page of records as lists of their values."""
+    return [r.as_list() for r in records]
+
+
+async def records_response(records: Sequence[Record], response: Response, stream: bool,
+                           total: int) -> Union[List[List[str]], Response]:
+    """Return a page of records as a JSON array, or as a streamed newline delimited JSON response.
+
+    Pages from the store may read records lazily, so they're only read in the threadpool, a batch at a time when
+    streaming. total is the number of records the page was taken from, as counted by the store inside the
+    threadpool, so the event loop never waits on the store's lock.
+    """
+    headers = {'X-Total-Count': str(total)}
+    if stream:
+        return StreamingResponse(_ndjson_lines(records), media_type='application/x-ndjson', headers=headers)
+    response.headers.update(headers)
+    return await run_in_threadpool(_record_lists, records)
+
+
+@app.get('/records',
+         response_model=List[List[str]],
+         operation_id="get_records",
+         summary="Retrieve all records with optional sort and filters",
+         description="Retrieve all records with optional sort and filters. "
+                     "Multiple sorts are supported with the first being highest priority. "
+                     "Sorts are specified with the format [column number],[direction]. "
+                     "Example: 0,DESC to sort last name. Filters are applied before sorting, "
+                     "and a record must match every filter." + PAGE_DESCRIPTION)
+async def get_records(response: Response, sort: List[str] = Query(None), offset: int = OFFSET_QUERY,
+                      limit: Optional[int] = LIMIT_QUERY, stream: bool = STREAM_QUERY,
+                      filters: List[str] = FILTER_QUERY):
+    """Retrieve a page of records matching given filters with given sorting rules."""
+    if filters:
+        try:
+            filtered_records, total = await run_in_threadpool(web_records.filtered, filters, sort, offset, limit)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="sort or filter parameters are invalid")
+        return await records_response(filtered_records, response, stream, total)
+
+    try:
+        sorted_records, total = await run_in_threadpool(web_records.sorted, sort, offset, limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="sort parameters are invalid")
+    return await records_response(sorted_records, response, stream, total)
+
+
+@app.get('/records/email',
+         response_model=List[List[str]],
+         operation_id="get_records_email_sort",
+         summary="Retrieve all records with email sort ascending",
+         description="Retrieve all records with email sort ascending." + PAGE_DESCRIPTION)
+async def get_records_email_sort(response: Response, offset: int = OFFSET_QUERY, limit: Optional[int] = LIMIT_QUERY,
+                                 stream: bool = STREAM_QUERY):
+    """Retrieve a page of records with pre-selected email sort."""
+    return await get_records(response, ['2,ASC'], offset, limit, stream, None)
+
+
+@app.get('/records/birthdate',
+         response_model=List[List[str]],
+         operation_id="get_records_birthdate_sort",
+         summary="Retrieve all records with birthdate sort ascending",
+         description="Retrieve all records with birthdate sort ascending." + PAGE_DESCRIPTION)
+async def get_records_birthdate_sort(response: Response, offset: int = OFFSET_QUERY,
+                                     limit: Optional[int] = LIMIT_QUERY, stream: bool = STREAM_QUERY):
+    """Retrieve a page of records with pre-selected birthdate sort."""
+    return await get_records(response, ['4,ASC'], offset, limit, stream, None)
+
+
+@app.get('/records/name',
+         response_model=List[List[str]],
+         operation_id="get_records_name_sort",
+         summary="Retrieve all records with name sort ascending",
+         description="Retrieve all records with name sort ascending. Name is computed as '[First] [Last]'." +
+                     PAGE_DESCRIPTION)
+async def get_records_name_sort(response: Response, offset: int = OFFSET_QUERY, limit: Optional[int] = LIMIT_QUERY,
+                                stream: bool = STREAM_QUERY):
+    """Retrieve a page of records with pre-selected first + last name sort."""
+    named_records, total = await run_in_threadpool(web_records.sorted_by_name, offset, limit)
+    return await records_response(named_records, response, stream, total)
+
+
+@app.get('/metrics',
+         response_class=PlainTextResponse,
+         operation_id="get_metrics",
+         summary="Retrieve metrics",
+         description="Retrieve metrics in the Prometheus text format: stored record and sort cache gauges, plus "
+                     "request latency, parsing, parse error and sort time metrics when RECORDS_METRICS is set.")
+async def get_metrics() -> Response:
+    """Render store gauges and collected metrics for a Prometheus scrape."""
+    gauges = await run_in_threadpool(_store_gauges)
+    return PlainTextResponse(metrics.render(gauges), media_type='text/plain; version=0.0.4')
+
+
+def _store_gauges() -> Dict[str, Tuple[str, float]]:
+    """Return gauges of the stored records and the sort cache, counting records takes the store's lock."""
+    gauges = {'records_stored': ('Records held by the store.', len(web_records))}
+    for name, value in web_records.sort_cache.stats().items():
+        gauges[f'records_sort_cache_{name}'] = (f'Sort cache {name}.', value)
+    return gauges
+
+
+def customize_openapi():
+    """Customize the openapi dashboard and add a title / version."""
+    if app.openapi_schema:
+        return app.openapi_schema
+    openapi_schema = get_openapi(
+        title="Records Demo Application",
+        version="1.0",
+        description="Record Demo Application REST API Documentation",
+        routes=app.routes,
+    )
+    app.openapi_schema = openapi_schema
+    return app.openapi_schema
+
+
+app.openapi = customize_openapi
@@ -0,0 +1,87 @@
+"""Benchmarks Record memory footprint and csv writing throughput against the previous dataclass Record.
+
+Run from the project root: python -m benchmarks.record_memory
+"""
+import argparse
+import csv
+import io
+import random
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from typing import Callable, List
+
+from dateutil.parser import parse
+
+from models.record import Record
+
+
+@dataclass
+class LegacyRecord:
+    """Previous Record implementation, a plain dataclass holding a datetime."""
+
+    last_name: str
+    first_name: str
+    email: str
+    favorite_color: str
+    date_of_birth: datetime
+    _date_of_birth: datetime = field(init=False, repr=False)
+
+    @property
+    def date_of_birth(self) -> str:
+        """Return date in M/D/YYYY format."""
+        return self._date_of_birth.strftime("%m/%d/%Y")
+
+    @date_of_birth.setter
+    def date_of_birth(self, date_str: str):
+        self._date_of_birth = parse(date_str)
+
+    def as_list(self) -> List:
+        """Return a representation of a record as a list."""
+        return [self.last_name, self.first_name, self.email, self.favorite_color, self.date_of_birth]
+
+    def __iter__(self):
+        """Make records iterable, order is stable."""
+        return iter(self.as_list())
+
+
+def random_rows(n: int, seed: int) -> List[List[str]]:
+    """Build n pseudo random record rows."""
+    rng = random.Random(seed)
+    return [[f'Last{rng.randrange(500)}', f'First{rng.randrange(300)}', f'user{i}@example.com',
+             f'Color{rng.randrange(140)}', date.fromordinal(rng.randint(690000, 740000)).strftime('%m/%d/%Y')]
+            for i in range(n)]
+
+
+def measure(record_class: Callable, rows: List[List[str]]):
+    """Return (bytes held per record, seconds to build, seconds to write csv) for a record class."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    records = [record_class(*row) for row in rows]
+    build = time.perf_counter() - start
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    csv.writer(io.StringIO()).writerows(records)
+    write = time.perf_counter() - start
+    return held / len(rows), build, write
+
+
+def main():
+    """Command line entrypoint for this benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark Record memory and throughput against the legacy class')
+    parser.add_argument('-n', type=int, default=100000, help='Number of records to build')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for generated records')
+    args = parser.parse_args()
+
+    rows = random_rows(args.n, args.seed)
+    print(f'{"class":>14} {"bytes/record":>13} {"build (s)":>10} {"writerows (s)":>14}')
+    for name, record_class in [('LegacyRecord', LegacyRecord), ('Record', Record)]:
+        per_record, build, write = measure(record_class, rows)
+        print(f'{name:>14} {per_record:>13.0f} {build:>10.3f} {write:>14.3f}')
+
+
+if __name__ == '__main__':
+    main()
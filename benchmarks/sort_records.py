@@ -0,0 +1,80 @@
+"""Benchmarks sort_records as row count and the number of sort columns grow.
+
+Run from the project root: python -m benchmarks.sort_records
+"""
+import argparse
+import random
+import time
+from datetime import date
+from typing import Any, Callable, List
+
+from dateutil.parser import parse
+
+from domain.record import SORT_ENGINES, sort_records
+from models.record import Record
+
+SORT_SHAPES = [['0,ASC'], ['0,ASC', '4,DESC'], ['3,DESC', '0,ASC', '4,ASC']]
+
+
+def random_records(n: int, seed: int) -> List[Record]:
+    """Build n pseudo random Records, with low cardinality names and colors like real exports."""
+    rng = random.Random(seed)
+    last_names = [f'Last{i}' for i in range(500)]
+    first_names = [f'First{i}' for i in range(300)]
+    colors = [f'Color{i}' for i in range(140)]
+    return [Record(rng.choice(last_names),
+                   rng.choice(first_names),
+                   f'user{rng.randrange(n)}@example.com',
+                   rng.choice(colors),
+                   date.fromordinal(rng.randint(690000, 740000)).strftime('%m/%d/%Y')) for _ in range(n)]
+
+
+def legacy_sort_records(records: List[Record], sorts: List[str],
+                        normalize: Callable[[str], Any] = lambda value: value) -> List[Record]:
+    """Previous implementation, one full sort pass per spec re-parsing birth dates in every key call.
+
+    Strings are compared as normalize returns them, so the tests can use it as the reference order of a collation.
+    """
+    for sort in reversed(sorts):
+        col_number, direction = sort.split(',')
+        col_number = int(col_number)
+        key = (lambda r: parse(r[col_number])) if col_number == 4 else (lambda r: normalize(r[col_number]))
+        records = sorted(records, key=key, reverse=direction.lower() == 'desc')
+    return records
+
+
+def best_of(repeat: int, fn: Callable[[], object]) -> float:
+    """Return the fastest wall time of several runs, in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    """Command line entrypoint for this benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark sort_records scaling by rows and sort columns')
+    parser.add_argument('-n', type=int, nargs='+', default=[1000, 10000, 100000], help='Row counts to benchmark')
+    parser.add_argument('--legacy-max', type=int, default=10000,
+                        help='Largest row count to also time the previous per-pass implementation at')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement, the fastest is reported')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for generated records')
+    parser.add_argument('--engine', default='auto', choices=SORT_ENGINES, help='Sort engine to benchmark')
+    args = parser.parse_args()
+
+    print(f'{"rows":>10} {"columns":>8} {"sort_records (s)":>17} {"legacy (s)":>11} {"speedup":>8}')
+    for n in args.n:
+        records = random_records(n, args.seed)
+        for sorts in SORT_SHAPES:
+            current = best_of(args.repeat, lambda: sort_records(records, sorts, args.engine))
+            legacy, speedup = '-', '-'
+            if n <= args.legacy_max:
+                legacy_time = best_of(args.repeat, lambda: legacy_sort_records(records, sorts))
+                legacy, speedup = f'{legacy_time:.4f}', f'{legacy_time / current:.1f}x'
+            print(f'{n:>10} {len(sorts):>8} {current:>17.4f} {legacy:>11} {speedup:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""Reproducible benchmarks of ingest, sorting, memory, the API and command line startup, with machine-readable results.
+
+Inputs are generated from a seed and cached, so runs at the same sizes measure the same records. Save the results of a
+run and later compare another run against them, a regression exits with status 1.
+
+Run from the project root:
+    python -m benchmarks.suite -n 1000 100000 --output baseline.json
+    python -m benchmarks.suite -n 1000 100000 --baseline baseline.json
+"""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from fastapi.testclient import TestClient
+
+import api
+from benchmarks.sort_records import SORT_SHAPES, best_of
+from domain.record import read_records, sort_records
+from domain.store import RecordStore
+from models.record import Record, RecordFileType
+from scripts.generate_sample_inputs import pooled_records, vocabulary_pools, write_sample_file
+
+SUITES = ('parse', 'sort', 'memory', 'api', 'startup')
+DEFAULT_DATA_DIR = Path(tempfile.gettempdir()) / 'records-benchmark-data'
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+# Requests timed per endpoint: (label, method, path, query parameters), every GET is warmed up once first
+API_REQUESTS = [
+    ('GET /records sort 0,ASC', 'GET', '/records', {'sort': '0,ASC', 'limit': 100}),
+    ('GET /records sort 3,DESC 0,ASC', 'GET', '/records', {'sort': ['3,DESC', '0,ASC'], 'limit': 100}),
+    ('GET /records/email', 'GET', '/records/email', {'limit': 100}),
+    ('GET /records filter 3,prefix,A', 'GET', '/records', {'filter': '3,prefix,A', 'limit': 100}),
+    ('POST /records', 'POST', '/records', None),
+]
+
+Result = Dict[str, Any]
+
+
+def result(name: str, rows: int, value: float, unit: str, better: str) -> Result:
+    """Return a measurement, better is 'higher' or 'lower' and says which direction is an improvement."""
+    return {'name': name, 'rows': rows, 'value': value, 'unit': unit, 'better': better}
+
+
+def input_files(n: int, seed: int, data_dir: Path) -> Dict[RecordFileType, Path]:
+    """Return csv and binary files of n records generated from seed, generating them on first use."""
+    data_dir.mkdir(parents=True, exist_ok=True)
+    files = {fmt: data_dir / f'pooled-{n}-{seed}.{fmt.value}'
+             for fmt in (RecordFileType.COMMA_SEPARATED, RecordFileType.BINARY)}
+    for fmt, path in files.items():
+        if not path.exists():
+            # Written under a temporary name so an interrupted run never leaves a truncated cached input
+            partial = path.with_suffix('.partial')
+            write_sample_file(pooled_records(0, n, seed, vocabulary_pools(seed)), fmt, partial)
+            partial.rename(path)
+    return files
+
+
+def bench_parse(files: Dict[RecordFileType, Path], n: int, repeat: int) -> List[Result]:
+    """Measure records parsed per second for each input format."""
+    return [result(f'parse {fmt.value}', n, n / best_of(repeat, lambda: read_records([str(path)])), 'rows/s', 'higher')
+            for fmt, path in files.items()]
+
+
+def bench_sort(records: List[Record], repeat: int) -> List[Result]:
+    """Measure sort_records latency for each sort spec shape."""
+    return [result(f'sort {" ".join(sorts)}', len(records), best_of(repeat, lambda: sort_records(records, sorts)), 's',
+                   'lower') for sorts in SORT_SHAPES]
+
+
+def bench_memory(files: Dict[RecordFileType, Path], n: int) -> List[Result]:
+    """Measure the peak memory allocated reading the csv input and sorting it by the widest sort shape."""
+    tracemalloc.start()
+    try:
+        sort_records(read_records([str(files[RecordFileType.COMMA_SEPARATED])]), SORT_SHAPES[-1])
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return [result('memory peak', n, peak, 'bytes', 'lower'),
+            result('memory per record', n, peak / n, 'bytes', 'lower')]
+
+
+def bench_api(records: List[Record], requests: int) -> List[Result]:
+    """Measure latency percentiles and throughput of API requests against a store holding records."""
+    api.web_records = RecordStore()
+    api.web_records.extend(records)
+    client = TestClient(api.app)
+    body = {'record': 'Last,First,benchmark@example.com,Tan,1/1/1970', 'fmt': 'csv'}
+
+    results = []
+    for label, method, path, params in API_REQUESTS:
+        if method == 'GET':
+            client.get(path, params=params)
+        latencies = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            response = client.get(path, params=params) if method == 'GET' else client.post(path, json=body)
+            latencies.append(time.perf_counter() - start)
+            response.raise_for_status()
+
+        percentiles = statistics.quantiles(latencies, n=100, method='inclusive')
+        results += [result(f'{label} p50', len(records), percentiles[49], 's', 'lower'),
+                    result(f'{label} p95', len(records), percentiles[94], 's', 'lower'),
+                    result(f'{label} p99', len(records), percentiles[98], 's', 'lower'),
+                    result(f'{label} throughput', len(records), requests / sum(latencies), 'req/s', 'higher')]
+    return results
+
+
+def bench_startup(files: Dict[RecordFileType, Path], n: int, repeat: int) -> List[Result]:
+    """Measure the wall time of importing the command line in a fresh interpreter, and of a whole run on a csv input."""
+    def run_python(*args: str):
+        subprocess.run([sys.executable, *args], cwd=PROJECT_ROOT, stdout=subprocess.DEVNULL, check=True)
+
+    run_python('-c', 'import records')
+    return [result('startup import records', 0, best_of(repeat, lambda: run_python('-c', 'import records')), 's',
+                   'lower'),
+            result('startup cli sort 0,ASC', n, best_of(
+                repeat, lambda: run_python('records.py', str(files[RecordFileType.COMMA_SEPARATED]), '-s', '0,ASC')),
+                's', 'lower')]
+
+
+def compare(results: List[Result], baseline: List[Result], tolerance: float) -> List[Result]:
+    """Print each result against its baseline measurement and return those worse by more than tolerance."""
+    previous = {(r['name'], r['rows']): r['value'] for r in baseline}
+    regressions = []
+    print(f'{"benchmark":<40} {"rows":>10} {"baseline":>12} {"current":>12} {"change":>8}')
+    for r in results:
+        before = previous.get((r['name'], r['rows']))
+        if not before:
+            print(f'{r["name"]:<40} {r["rows"]:>10} {"-":>12} {r["value"]:>12.4g} {"new":>8}')
+            continue
+        change = r['value'] / before - 1
+        regressed = change < -tolerance if r['better'] == 'higher' else change > tolerance
+        if regressed:
+            regressions.append(r)
+        flag = ' REGRESSION' if regressed else ''
+        print(f'{r["name"]:<40} {r["rows"]:>10} {before:>12.4g} {r["value"]:>12.4g} {change:>+8.1%}{flag}')
+    return regressions
+
+
+def run(sizes: List[int], seed: int, suites: List[str], repeat: int, api_requests: int,
+        data_dir: Path) -> List[Result]:
+    """Run the selected suites at every size and return their results."""
+    results = []
+    if 'startup' in suites:
+        # Startup is dominated by imports, so it is only measured at the smallest size
+        results += bench_startup(input_files(min(sizes), seed, data_dir), min(sizes), repeat)
+    for n in sizes:
+        files = input_files(n, seed, data_dir)
+        if 'parse' in suites:
+            results += bench_parse(files, n, repeat)
+        if 'memory' in suites:
+            results += bench_memory(files, n)
+        if 'sort' in suites or 'api' in suites:
+            records = read_records([str(files[RecordFileType.BINARY])])
+            if 'sort' in suites:
+                results += bench_sort(records, repeat)
+            if 'api' in suites:
+                results += bench_api(records, api_requests)
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Command line entrypoint for the benchmark suite, returns the process exit status."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark ingest, sorting, memory, the API and startup on seeded inputs')
+    parser.add_argument('-n', type=int, nargs='+', default=[1000, 10000, 100000], help='Row counts to benchmark')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for generated inputs')
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=list(SUITES), help='Benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per parse, sort and startup measurement, the fastest counts')
+    parser.add_argument('--api-requests', type=int, default=200, help='Timed requests per API endpoint')
+    parser.add_argument('--data-dir', type=Path, default=DEFAULT_DATA_DIR,
+                        help='Directory generated inputs are cached in')
+    parser.add_argument('--output', type=Path, help='Write results as JSON to this file')
+    parser.add_argument('--baseline', type=Path, help='Compare results against a JSON results file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Fraction a result may be worse than its baseline before it is a regression')
+    args = parser.parse_args(argv)
+
+    results = run(args.n, args.seed, args.suites, args.repeat, args.api_requests, args.data_dir)
+    if args.output:
+        meta = {'created': datetime.now(timezone.utc).isoformat(), 'python': platform.python_version(),
+                'platform': platform.platform(), 'seed': args.seed}
+        args.output.write_text(json.dumps({'meta': meta, 'results': results}, indent=2))
+
+    baseline = json.loads(args.baseline.read_text())['results'] if args.baseline else []
+    regressions = compare(results, baseline, args.tolerance)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,44 @@
+"""Collations, the orders strings can be sorted in, and sort keys normalizing strings to them."""
+import locale
+from functools import lru_cache
+from typing import Any, Callable, List, Optional
+
+# Code point order, case-insensitive order, or the order of the LC_COLLATE locale
+COLLATIONS = ('ordinal', 'casefold', 'locale')
+# Distinct strings whose keys are remembered per collation, so repeated values are only normalized once
+COLLATION_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=COLLATION_CACHE_SIZE)
+def _casefold_key(value: str) -> str:
+    """Return a key ordering value case-insensitively."""
+    return value.casefold()
+
+
+@lru_cache(maxsize=COLLATION_CACHE_SIZE)
+def _locale_key(value: str) -> str:
+    """Return a key ordering value in the LC_COLLATE locale's order, which can't hold NUL characters."""
+    return locale.strxfrm(value.replace('\0', ''))
+
+
+def collation_key(collation: str) -> Optional[Callable[[str], Any]]:
+    """Return the function mapping strings to keys that order them in collation, None for plain code point order.
+
+    Locale keys follow LC_COLLATE as it was when each was first computed, set it once with setlocale before sorting.
+    """
+    if collation not in COLLATIONS:
+        raise ValueError(f'Fatal error, {collation} is not a collation.')
+    return {'ordinal': None, 'casefold': _casefold_key, 'locale': _locale_key}[collation]
+
+
+def collation_ranks(values: List[str], collate: Callable[[str], Any]) -> List[int]:
+    """Map strings to the rank of their key under collate, normalizing each distinct string only once.
+
+    Strings with equal keys, such as 'Tan' and 'tan' when case-insensitive, share a rank.
+    """
+    # Each distinct string is normalized once here anyway, skip the key cache rather than churn through it
+    collate = getattr(collate, '__wrapped__', collate)
+    keys = {value: collate(value) for value in set(values)}
+    key_ranks = {key: rank for rank, key in enumerate(sorted(set(keys.values())))}
+    ranks = {value: key_ranks[key] for value, key in keys.items()}
+    return list(map(ranks.__getitem__, values))
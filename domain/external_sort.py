@@ -0,0 +1,141 @@
+"""External merge sort for record files too large to sort in memory."""
+import heapq
+import pickle
+import re
+import tempfile
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from domain.record import PARSE_ERRORS, parse_counted_record_file, parse_sorts, record_file_type, record_identity, \
+    record_sort_key, report_malformed_file, sort_order
+from models.record import Record
+
+# Rough in-memory footprint of a Record beyond its string contents, used to bound sort chunks
+RECORD_OVERHEAD_BYTES = 600
+# Maximum number of sorted runs merged at once, larger run counts are merged in several passes
+MERGE_FAN_IN = 64
+MAX_SPILL_BLOCK_SIZE = 4096
+
+_MEMORY_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# Records are tagged with the index of the file they came from so a file that fails part way through can still be
+# dropped entirely after some of its records were spilled
+TaggedRecord = Tuple[int, Record]
+
+
+def memory_size(size: str) -> int:
+    """Parse a memory size such as 512M, 2G or 65536 into a number of bytes."""
+    match = re.fullmatch(r'(\d+)([KMG]?)B?', size.strip().upper())
+    if not match or int(match.group(1)) <= 0:
+        raise ValueError(f'{size} is not a valid memory size')
+    return int(match.group(1)) * _MEMORY_SIZE_UNITS[match.group(2)]
+
+
+def _approximate_size(record: Record) -> int:
+    """Estimate the bytes held in memory by a record."""
+    return RECORD_OVERHEAD_BYTES + len(record.last_name) + len(record.first_name) + len(record.email) + \
+        len(record.favorite_color)
+
+
+def _write_run(tagged_records: Iterable[TaggedRecord], path: Path, block_size: int) -> Path:
+    """Write a sorted sequence of tagged records to a run file as a sequence of pickled blocks."""
+    with path.open('wb') as out_stream:
+        block = []
+        for tagged in tagged_records:
+            block.append(tagged)
+            if len(block) >= block_size:
+                pickle.dump(block, out_stream, protocol=pickle.HIGHEST_PROTOCOL)
+                block = []
+        if block:
+            pickle.dump(block, out_stream, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def _read_run(path: Path) -> Iterator[TaggedRecord]:
+    """Lazily read a sorted run back one block at a time."""
+    with path.open('rb') as in_stream:
+        while True:
+            try:
+                block = pickle.load(in_stream)
+            except EOFError:
+                return
+            yield from block
+
+
+def _merge_runs(runs: List[Path], key) -> Iterator[TaggedRecord]:
+    """K-way merge sorted runs, ties keep the order of the runs they came from."""
+    return heapq.merge(*[_read_run(run) for run in runs], key=lambda tagged: key(tagged[1]))
+
+
+def external_sort_records(files: List[str], sorts: Optional[List[str]], max_memory: int,
+                          spill_dir: Optional[str] = None, engine: str = 'auto', collation: str = 'ordinal',
+                          key_columns: Optional[Tuple[int, ...]] = None) -> Iterator[Record]:
+    """Lazily read, sort and yield the records of files while holding roughly max_memory bytes of records.
+
+    Records are read in chunks of about max_memory bytes, each chunk is sorted and spilled to a temporary run file,
+    and runs are k-way merged. The output order and file skipping rules match read_records followed by sort_records.
+    engine picks how each chunk is sorted, and strings compare in collation. With key_columns, only the first record
+    with each key is kept, as with dedupe_records, which takes a hash set of every key read.
+    """
+    specs = parse_sorts(sorts) if sorts else []
+    key = record_sort_key(specs, collation)
+    block_size = max(16, min(MAX_SPILL_BLOCK_SIZE, max_memory // (RECORD_OVERHEAD_BYTES * 2 * MERGE_FAN_IN)))
+    failed_files = set()
+    identity = record_identity(key_columns) if key_columns else None
+    seen_keys = set()
+
+    with tempfile.TemporaryDirectory(prefix='records-', dir=spill_dir) as tmp_dir:
+        runs = []
+
+        def spill(chunk: List[TaggedRecord]) -> Path:
+            ordered = [chunk[i] for i in sort_order([record for _, record in chunk], specs, engine, collation)]
+            return _write_run(ordered, Path(tmp_dir) / f'run-{len(runs)}', block_size)
+
+        chunk, chunk_bytes = [], 0
+        for file_index, file in enumerate(files):
+            fmt = record_file_type(file)
+            if fmt is None:
+                continue
+
+            # Keys seen in a file only count once the whole file parsed, its records are dropped otherwise
+            file_keys = set()
+            try:
+                for record in parse_counted_record_file(file, fmt):
+                    if identity is not None:
+                        record_key = identity(record)
+                        if record_key in seen_keys or record_key in file_keys:
+                            continue
+                        file_keys.add(record_key)
+                    chunk.append((file_index, record))
+                    chunk_bytes += _approximate_size(record)
+                    if chunk_bytes >= max_memory:
+                        runs.append(spill(chunk))
+                        chunk, chunk_bytes = [], 0
+            except PARSE_ERRORS:
+                report_malformed_file(file)
+                failed_files.add(file_index)
+                continue
+            seen_keys |= file_keys
+
+        chunk = [tagged for tagged in chunk if tagged[0] not in failed_files]
+        if not runs:
+            # Everything fit in memory, no need to touch the disk
+            yield from (chunk[i][1] for i in sort_order([record for _, record in chunk], specs, engine, collation))
+            return
+        if chunk:
+            runs.append(spill(chunk))
+
+        # Merge groups of neighbouring runs until one pass can merge them all, neighbours keep ties stable
+        generation = 0
+        while len(runs) > MERGE_FAN_IN:
+            generation += 1
+            merged_runs = []
+            for start in range(0, len(runs), MERGE_FAN_IN):
+                group = runs[start:start + MERGE_FAN_IN]
+                path = Path(tmp_dir) / f'merge-{generation}-{len(merged_runs)}'
+                merged_runs.append(_write_run(_merge_runs(group, key), path, block_size))
+                for run in group:
+                    run.unlink()
+            runs = merged_runs
+
+        yield from (record for file_index, record in _merge_runs(runs, key) if file_index not in failed_files)
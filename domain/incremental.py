@@ -0,0 +1,116 @@
+"""Incremental sorted outputs, new record files are merged into an already sorted output instead of re-sorting it all.
+
+A sidecar manifest next to the output records the sort, format and collation it was written with, the checksum of
+every source file merged into it, and the checksum of the output itself. A file whose path and checksum are already
+in the manifest is skipped. When the settings differ, a source file changed, or the output no longer matches its
+manifest, the output is rebuilt from the files given.
+"""
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from domain.external_sort import external_sort_records
+from domain.record import format_sorts, merge_sorted_records, parse_record_file, parse_sorts, read_records, \
+    sort_records, write_records
+from models.record import Record, RecordFileType
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_SUFFIX = '.manifest.json'
+MANIFEST_VERSION = 1
+CHECKSUM_BLOCK_SIZE = 1024 ** 2
+
+
+def file_checksum(path: str) -> str:
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as in_stream:
+        for block in iter(lambda: in_stream.read(CHECKSUM_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def manifest_path(output: str) -> Path:
+    """Return the path of the manifest describing a sorted output."""
+    return Path(output + MANIFEST_SUFFIX)
+
+
+def _read_manifest(output: str) -> Optional[Dict]:
+    """Return the manifest of an output, None when either is missing or the manifest is unreadable."""
+    path = manifest_path(output)
+    if not path.exists() or not Path(output).exists():
+        return None
+    try:
+        manifest = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def _merged_sources(manifest: Optional[Dict], settings: Dict[str, str], output: str,
+                    checksums: Dict[str, str]) -> Optional[Dict[str, str]]:
+    """Return the source checksums already merged into output, None when it must be rebuilt, logging why."""
+    if manifest is None:
+        return None
+    if any(manifest.get(name) != value for name, value in settings.items()):
+        logger.info(f'{output} was written with different settings, it will be rebuilt')
+        return None
+    sources = manifest.get('files', {})
+    if any(checksums.get(path, checksum) != checksum for path, checksum in sources.items()):
+        logger.info(f'source files of {output} changed, it will be rebuilt')
+        return None
+    if manifest.get('output') != file_checksum(output):
+        logger.info(f'{output} does not match its manifest, it will be rebuilt')
+        return None
+    return sources
+
+
+def update_sorted_output(files: List[str], sorts: Optional[List[str]], fmt: str, output: str, jobs: int = 1,
+                         engine: str = 'auto', collation: str = 'ordinal', max_memory: Optional[int] = None,
+                         spill_dir: Optional[str] = None) -> List[str]:
+    """Merge the records of files not yet in a sorted output into it, returning the files merged.
+
+    Only new files are read and sorted, in a pool of jobs processes or with an external sort holding roughly
+    max_memory bytes of records, and the existing output is streamed through a single linear merge with them. Ties
+    keep existing records first, so the output matches sorting every file merged so far in the order they arrived.
+    Records of files dropped from the file list stay in the output until it is rebuilt.
+    """
+    fmt = RecordFileType(fmt)
+    specs = parse_sorts(sorts) if sorts else []
+    settings = {'sort': format_sorts(specs), 'format': fmt.value, 'collation': collation}
+    # Sources are identified by absolute path, so runs from any directory agree
+    paths = {file: str(Path(file).resolve()) for file in files}
+    checksums = {paths[file]: file_checksum(file) for file in files}
+
+    sources = _merged_sources(_read_manifest(output), settings, output, checksums)
+    new_files = [file for file in files if sources is None or paths[file] not in sources]
+    if sources is not None and not new_files:
+        return []
+
+    if max_memory:
+        new_records: Iterator[Record] = external_sort_records(new_files, sorts, max_memory, spill_dir, engine,
+                                                              collation)
+    else:
+        new_records = iter(sort_records(read_records(new_files, jobs), sorts, engine, collation=collation))
+    existing_records = parse_record_file(output, fmt) if sources is not None else iter(())
+    merged = merge_sorted_records([existing_records, new_records], specs, collation)
+
+    partial = Path(output + '.partial')
+    with (partial.open('wb') if fmt is RecordFileType.BINARY else partial.open('w', newline='')) as out_stream:
+        write_records(merged, fmt, out_stream)
+    output_checksum = file_checksum(str(partial))
+    os.replace(partial, output)
+
+    # Written after the output, a crash in between leaves an output that doesn't match its manifest and is rebuilt
+    merged_sources = dict(sources or {})
+    merged_sources.update((paths[file], checksums[paths[file]]) for file in new_files)
+    manifest = {'version': MANIFEST_VERSION, **settings, 'files': merged_sources, 'output': output_checksum}
+    partial = Path(str(manifest_path(output)) + '.partial')
+    partial.write_text(json.dumps(manifest, indent=2))
+    os.replace(partial, manifest_path(output))
+    return new_files
@@ -0,0 +1,148 @@
+"""Counters and latency histograms for the hot paths, rendered in the Prometheus text exposition format.
+
+Collection is off by default and every instrumented path checks enabled before doing any work, so disabled metrics
+cost one attribute lookup per call. Call enable() to start collecting.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# Upper bounds, in seconds, of latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Type and help text of every metric, in the order they are rendered
+METRICS = {
+    'records_http_request_duration_seconds': ('histogram', 'API request latency by method, route and status.'),
+    'records_process_seconds': ('histogram', 'Time spent in command line runs of process_records.'),
+    'records_read_seconds': ('histogram', 'Time spent reading record files with read_records.'),
+    'records_parsed_total': ('counter', 'Records parsed from files and request bodies, by source format.'),
+    'records_parse_errors_total': ('counter', 'Record files, records or request lines that failed to parse.'),
+    'records_date_parse_fallbacks_total': ('counter', 'Distinct date strings parsed by dateutil, not a fast path.'),
+    'records_sort_seconds': ('histogram', 'Time spent ordering records, by sort spec.'),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+enabled = False
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, Labels], float] = {}
+# Per bucket counts, with one more bucket for values above the last bound, and the sum of observed values
+_histograms: Dict[Tuple[str, Labels], Tuple[List[int], List[float]]] = {}
+
+
+def enable():
+    """Start collecting metrics."""
+    global enabled
+    enabled = True
+
+
+def reset():
+    """Stop collecting metrics and discard everything collected."""
+    global enabled
+    enabled = False
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    """Return labels in a canonical hashable form."""
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def count(name: str, amount: float = 1, **labels):
+    """Add amount to a counter, when enabled."""
+    if not enabled:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name: str, value: float, **labels):
+    """Record a value in a latency histogram, when enabled."""
+    if not enabled:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        buckets, total = _histograms.setdefault(key, ([0] * (len(LATENCY_BUCKETS) + 1), [0.0]))
+        buckets[bisect_left(LATENCY_BUCKETS, value)] += 1
+        total[0] += value
+
+
+@contextmanager
+def timer(name: str, **labels) -> Iterator[None]:
+    """Time a block into a latency histogram. Check enabled first on hot paths, to skip even entering the block."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name: str) -> Callable[[Callable], Callable]:
+    """Decorate a function to time its calls into a latency histogram, when enabled."""
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def _format_labels(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    """Format labels as a Prometheus label set, empty when there are none."""
+    pairs = labels + extra
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def render(gauges: Dict[str, Tuple[str, float]] = None) -> str:
+    """Render every metric, plus gauges of (help text, value) by name, in the Prometheus text format."""
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, (list(buckets), total[0])) for key, (buckets, total) in _histograms.items())
+
+    lines = []
+    for name, (help_text, value) in (gauges or {}).items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {value}']
+    for name, (kind, help_text) in METRICS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        for (counter_name, labels), value in counters:
+            if counter_name == name:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+        for (histogram_name, labels), (buckets, total) in histograms:
+            if histogram_name != name:
+                continue
+            cumulative = 0
+            for bound, bucket in zip(LATENCY_BUCKETS + (float('inf'),), buckets):
+                cumulative += bucket
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{_format_labels(labels, (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def summary() -> str:
+    """Summarize counters and histograms for people, one line each, with histogram counts, totals and means."""
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, (sum(buckets), total[0])) for key, (buckets, total) in _histograms.items())
+
+    lines = [f'{name}{_format_labels(labels)} {value:g}' for (name, labels), value in counters]
+    for (name, labels), (observations, total) in histograms:
+        lines.append(f'{name}{_format_labels(labels)} count={observations} total={total:.6f}s '
+                     f'mean={total / observations:.6f}s')
+    return '\n'.join(lines)
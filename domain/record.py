@@ -1,70 +1,530 @@
 """Record domain functionality."""
 import csv
+import heapq
+import io
 import logging
-from typing import List, Optional
+import os
+import tempfile
+from functools import partial
+from itertools import groupby, islice
+from operator import attrgetter, eq, ge, gt, le, lt
+from typing import Any, Callable, Hashable, Iterable, Iterator, List, Optional, Tuple
 
-from models.record import Record, RecordFileType
-
-from dateutil.parser import parse, ParserError
+from domain import metrics
+from domain.collation import collation_key, collation_ranks
+from models.binary import BinaryFormatError, read_binary_records, write_binary_records
+from models import dates
+from models.dates import parse_date_ordinal
+from models.record import DATE_OF_BIRTH_COLUMN, RECORD_COLUMNS, Record, RecordFileType
 
 logger = logging.getLogger(__name__)
 
+# Models don't depend on the domain, so dates falling back to dateutil are counted through their hook
+dates.on_fallback = partial(metrics.count, 'records_date_parse_fallbacks_total')
+
+
+# Files larger than this are split into several parse tasks when reading records in parallel
+PARALLEL_SPLIT_BYTES = 16 * 1024 ** 2
+# Bytes of a file's records iter_records holds in memory while checking the file parses, beyond it they go to disk
+SPOOL_MAX_BYTES = 8 * 1024 ** 2
+
+SORT_ENGINES = ('auto', 'python', 'numpy')
+# Record count from which the 'auto' sort engine uses NumPy, below it conversion costs outweigh the gains
+COLUMNAR_THRESHOLD = 20000
+# sort_records selects a limit with a heap rather than sorting everything when records outnumber it this many times
+TOP_K_RATIO = 32
+
+# Comparisons filters can make between a column and a value
+FILTER_OPERATORS = {'eq': eq, 'prefix': str.startswith, 'lt': lt, 'le': le, 'gt': gt, 'ge': ge}
+
+# Which of the records sharing a key dedupe_records keeps
+DEDUPE_MODES = ('first', 'last')
+# Key columns identifying records unless others are given
+EMAIL_KEY = (RECORD_COLUMNS.index('email'),)
+
+# Failures that mean a record file is malformed, the whole file is skipped rather than partially read. Unparseable dates
+# raise dateutil's ParserError, a ValueError, which is caught as such so dateutil is only imported once a date needs it,
+# and dates too large for dateutil overflow
+PARSE_ERRORS = (TypeError, UnicodeDecodeError, ValueError, OverflowError, BinaryFormatError, csv.Error)
+
+
+def record_file_type(file: str) -> Optional[RecordFileType]:
+    """Return the format of a record file from its extension, warning and returning None if unsupported."""
+    try:
+        *_, extension = file.rpartition(".")
+        return RecordFileType(extension)
+    except ValueError:
+        logger.warning(f'{file} is an unsupported file format, it will be skipped')
+        return None
+
+
+def parse_record_file(file: str, fmt: RecordFileType) -> Iterator[Record]:
+    """Lazily map the rows of a record file to Records, raising one of PARSE_ERRORS on malformed input."""
+    if fmt is RecordFileType.BINARY:
+        with open(file, 'rb') as in_stream:
+            yield from read_binary_records(in_stream)
+        return
+
+    with open(file, 'r', newline='') as in_stream:
+        for row in csv.reader(in_stream, delimiter=RecordFileType.delimiters[fmt]):
+            yield Record(*row)
+
+
+def _count_parsed(records: Iterator[Record], fmt: RecordFileType) -> Iterator[Record]:
+    """Yield records, counting them in records_parsed_total once they have all been parsed."""
+    parsed = 0
+    for parsed, record in enumerate(records, 1):
+        yield record
+    metrics.count('records_parsed_total', parsed, format=fmt.value)
+
+
+def parse_counted_record_file(file: str, fmt: RecordFileType) -> Iterator[Record]:
+    """Lazily parse a record file like parse_record_file, counting its records in the metrics when they're enabled."""
+    records = parse_record_file(file, fmt)
+    return _count_parsed(records, fmt) if metrics.enabled else records
+
+
+def report_malformed_file(file: str):
+    """Warn that a record file could not be parsed and is skipped, counting it in the metrics."""
+    logger.warning(f'{file} could not be parsed, it will be skipped')
+    metrics.count('records_parse_errors_total', source='file')
+
+
+def _file_byte_ranges(file: str, split_bytes: int) -> List[Tuple[int, int]]:
+    """Split a file into byte ranges of roughly split_bytes that start and end on line boundaries."""
+    size = os.path.getsize(file)
+    ranges, start = [], 0
+    with open(file, 'rb') as in_stream:
+        while start < size:
+            in_stream.seek(min(start + split_bytes, size))
+            in_stream.readline()
+            end = in_stream.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _parse_record_file_range(file: str, fmt: RecordFileType, start: int, end: int) -> Optional[Tuple[List, ...]]:
+    """Parse the records in a byte range of a file into columns, returning None when it is malformed.
+
+    Columns of plain strings and date ordinals pickle several times faster than Records on their way back from a pool.
+    """
+    with open(file, 'rb') as in_stream:
+        in_stream.seek(start)
+        data = in_stream.read(end - start)
+    try:
+        if fmt is RecordFileType.BINARY:
+            records = list(read_binary_records(io.BytesIO(data)))
+        else:
+            # Decode with the same default encoding open() would use for a whole file
+            in_text = io.TextIOWrapper(io.BytesIO(data), newline='')
+            records = [Record(*row) for row in csv.reader(in_text, delimiter=RecordFileType.delimiters[fmt])]
+    except PARSE_ERRORS:
+        return None
+    return tuple(list(map(attrgetter(column), records)) for column in RECORD_COLUMNS[:-1] + ('date_of_birth_ordinal',))
+
+
+def _read_records_parallel(files: List[str], jobs: int) -> List[Record]:
+    """Parse files, split into ranges when large, in a pool of jobs processes. See read_records."""
+    tasks = []
+    for file in files:
+        fmt = record_file_type(file)
+        if fmt is RecordFileType.BINARY:
+            # Binary files have no line boundaries to split on
+            tasks.append((file, fmt, 0, os.path.getsize(file)))
+        elif fmt is not None:
+            tasks += [(file, fmt, start, end) for start, end in _file_byte_ranges(file, PARALLEL_SPLIT_BYTES)]
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(_parse_record_file_range, *zip(*tasks))) if tasks else []
+
+    records = []
+    for file, file_tasks in groupby(zip(tasks, results), key=lambda task_result: task_result[0][0]):
+        file_results = [result for _, result in file_tasks]
+        if any(result is None for result in file_results):
+            report_malformed_file(file)
+            continue
+        for columns in file_results:
+            records += map(Record.from_ordinal, *columns)
+            metrics.count('records_parsed_total', len(columns[0]), format=record_file_type(file).value)
+
+    return records
+
+
+@metrics.timed('records_read_seconds')
+def read_records(files: List[str], jobs: int = 1) -> List[Record]:
+    """Given a list of files, combines them and maps them to Record entries.
+
+    With jobs greater than one, files are parsed in a pool of that many processes. Files larger than
+    PARALLEL_SPLIT_BYTES are split on line boundaries, so they must not hold quoted values spanning lines.
+    """
+    if jobs > 1:
+        return _read_records_parallel(files, jobs)
 
-def read_records(files: List[str]) -> List[Record]:
-    """Given a list of files, combines them and maps them to Record entries."""
     records = []
     for file in files:
-        try:
-            *_, extension = file.rpartition(".")
-            fmt = RecordFileType(extension)
-        except ValueError:
-            logger.warning(f'{file} is an unsupported file format, it will be skipped')
+        fmt = record_file_type(file)
+        if fmt is None:
             continue
 
         try:
-            with open(file, 'r', newline='') as in_stream:
-                records += [Record(*row) for row in csv.reader(in_stream, delimiter=RecordFileType.delimiters[fmt])]
-        except (TypeError, UnicodeDecodeError, ParserError):
-            logger.warning(f'{file} could not be parsed, it will be skipped')
+            file_records = list(parse_record_file(file, fmt))
+        except PARSE_ERRORS:
+            report_malformed_file(file)
             continue
+        records += file_records
+        metrics.count('records_parsed_total', len(file_records), format=fmt.value)
 
     return records
 
 
+def iter_records(files: List[str]) -> Iterator[Record]:
+    """Lazily yield the Records of files, with the same format detection, warnings and skipping as read_records.
+
+    Each file is parsed whole into a temporary spool of binary records before any of its records are yielded, so a
+    file that turns out to be malformed part way through is skipped entirely, while memory stays bounded by
+    SPOOL_MAX_BYTES however large the file is.
+    """
+    for file in files:
+        fmt = record_file_type(file)
+        if fmt is None:
+            continue
+
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as spool:
+            try:
+                write_binary_records(parse_counted_record_file(file, fmt), spool)
+            except PARSE_ERRORS:
+                report_malformed_file(file)
+                continue
+            spool.seek(0)
+            yield from read_binary_records(spool)
+
+
+def write_records(records: Iterable[Record], fmt: RecordFileType, output_stream):
+    """Write records to a stream in the given format.
+
+    Binary records are written to the stream's underlying binary buffer when given a text stream such as stdout.
+    """
+    if fmt is RecordFileType.BINARY:
+        output_stream.flush()
+        write_binary_records(records, getattr(output_stream, 'buffer', output_stream))
+        output_stream.flush()
+        return
+    csv.writer(output_stream, delimiter=RecordFileType.delimiters[fmt]).writerows(records)
+
+
+def parse_sorts(sorts: List[str], column_count: int = len(RECORD_COLUMNS)) -> List[Tuple[int, bool]]:
+    """Validate sorts such as '0,DESC' and return (column number, descending) pairs, highest priority first.
+
+    Later sorts by a column already sorted by can't change the order and are dropped, so equivalent sorts parse to the
+    same pairs, at most one per column.
+    """
+    specs = []
+    for sort in sorts:
+        bad_sort_error = f'Fatal error, {sort} is an invalid sort.'
+
+        if sort.count(',') != 1:
+            raise ValueError(bad_sort_error)
+
+        col_number, direction = sort.split(',')
+        if not col_number.isdigit() or direction.lower() not in ["asc", "desc"]:
+            raise ValueError(bad_sort_error)
+
+        col_number = int(col_number)
+        if col_number < 0 or col_number >= column_count:
+            raise ValueError(f'Fatal error, {col_number} is not an in-range column number.')
+
+        specs.append((col_number, direction.lower() == "desc"))
+    return distinct_sorts(specs)
+
+
+def distinct_sorts(specs: List[Tuple[int, bool]]) -> List[Tuple[int, bool]]:
+    """Return parsed sorts without later sorts by an already sorted column, which can't change the order."""
+    columns = set()
+    return [(col_number, desc) for col_number, desc in specs if not (col_number in columns or columns.add(col_number))]
+
+
+def parse_filters(filters: List[str]) -> List[Tuple[int, str, Any]]:
+    """Validate filters such as '3,eq,Tan' and return (column number, operator, value) triples.
+
+    Values are everything after the second comma, so they may hold commas themselves. Date of birth values are parsed
+    to ordinals like stored dates of birth, and only string columns support prefix filters.
+    """
+    parsed = []
+    for spec in filters:
+        bad_filter_error = f'Fatal error, {spec} is an invalid filter.'
+
+        if spec.count(',') < 2:
+            raise ValueError(bad_filter_error)
+
+        col_number, operator, value = spec.split(',', 2)
+        operator = operator.lower()
+        if not col_number.isdigit() or operator not in FILTER_OPERATORS:
+            raise ValueError(bad_filter_error)
+
+        col_number = int(col_number)
+        if col_number >= len(RECORD_COLUMNS):
+            raise ValueError(f'Fatal error, {col_number} is not an in-range column number.')
+
+        if col_number == DATE_OF_BIRTH_COLUMN:
+            if operator == 'prefix':
+                raise ValueError(bad_filter_error)
+            try:
+                value = parse_date_ordinal(value)
+            except (ValueError, OverflowError):
+                raise ValueError(bad_filter_error)
+
+        parsed.append((col_number, operator, value))
+    return parsed
+
+
+def parse_key_columns(key: str) -> Tuple[int, ...]:
+    """Validate a key such as '2' or '0,1' and return the column numbers identifying a record."""
+    col_numbers = key.split(',')
+    if not all(col_number.isdigit() for col_number in col_numbers):
+        raise ValueError(f'Fatal error, {key} is an invalid key.')
+    if any(int(col_number) >= len(RECORD_COLUMNS) for col_number in col_numbers):
+        raise ValueError(f'Fatal error, {key} has an out of range column number.')
+    return tuple(dict.fromkeys(map(int, col_numbers)))
+
+
+def record_identity(key_columns: Tuple[int, ...]) -> Callable[[Record], Hashable]:
+    """Return a function extracting the hashable identity of a Record from its key columns, compared exactly."""
+    return attrgetter(*[_sort_attribute(col_number) for col_number in key_columns])
+
+
+def dedupe_records(records: Iterable[Record], key_columns: Tuple[int, ...], keep: str = 'first') -> Iterator[Record]:
+    """Lazily drop records whose key columns equal an earlier record's, through a hash set of keys.
+
+    keep 'first' streams, holding only the keys seen. keep 'last' holds a record per key and yields once records are
+    exhausted, each later record replacing the earlier one in its place, like an upsert.
+    """
+    if keep not in DEDUPE_MODES:
+        raise ValueError(f'Fatal error, {keep} is not a dedupe mode.')
+    identity = record_identity(key_columns)
+    if keep == 'last':
+        # A dict keeps keys in first insertion order when their value is replaced
+        latest = {}
+        for record in records:
+            latest[identity(record)] = record
+        yield from latest.values()
+        return
+
+    seen = set()
+    for record in records:
+        key = identity(record)
+        if key not in seen:
+            seen.add(key)
+            yield record
+
+
+def filter_predicate(filters: List[Tuple[int, str, Any]]) -> Callable[[Record], bool]:
+    """Return a function telling whether a Record matches every parsed filter."""
+    checks = [(column_getter(col_number), FILTER_OPERATORS[operator], value) for col_number, operator, value in filters]
+    return lambda record: all(compare(getter(record), value) for getter, compare, value in checks)
+
+
+def _sort_attribute(column_number: int) -> str:
+    """Return the name of the Record attribute holding the best representation of a column for sorting."""
+    if column_number == DATE_OF_BIRTH_COLUMN:
+        # birth dates should be sorted temporally vs alphabetically, at day granularity
+        return 'date_of_birth_ordinal'
+    return RECORD_COLUMNS[column_number]
+
+
+def column_getter(column_number: int, collation: str = 'ordinal') -> Callable[[Record], Any]:
+    """Return a function extracting the best representation of a Record's column for sorting in collation."""
+    getter = attrgetter(_sort_attribute(column_number))
+    collate = collation_key(collation)
+    if collate is None or column_number == DATE_OF_BIRTH_COLUMN:
+        return getter
+    return lambda record: collate(getter(record))
+
+
 def column_value_for_sort(record: Record, column_number: int):
     """Return the best representation of a Record's column for sorting."""
-    if record[column_number] == record.date_of_birth:
-        # birth dates should be sorted temporally vs alphabetically
-        return parse(record[column_number])
-    else:
-        return record[column_number]
+    return column_getter(column_number)(record)
+
+
+class _Descending:
+    """Wraps a value so that it orders in reverse, for keys that must compare across separately sorted runs."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _descending_getter(column_number: int, collation: str) -> Callable[[Record], Any]:
+    """Return a column getter whose values order in reverse."""
+    getter = column_getter(column_number, collation)
+    if column_number == DATE_OF_BIRTH_COLUMN:
+        return lambda record: -getter(record)
+    return lambda record: _Descending(getter(record))
+
 
+def record_sort_key(specs: List[Tuple[int, bool]], collation: str = 'ordinal') -> Callable[[Record], Tuple]:
+    """Return a key function for parsed sorts in collation whose keys compare across any set of records.
 
-def sort_records(records: List[Record], sorts: List[str]) -> Optional[List[Record]]:
-    """Sorts records and returns a new list."""
-    sorted_records = records
+    sort_records ranks descending strings within the list being sorted, which is cheaper but only meaningful within
+    that list. Use this key when separately sorted sequences must be merged or compared.
+    """
+    getters = [_descending_getter(col_number, collation) if desc else column_getter(col_number, collation)
+               for col_number, desc in specs]
+    return lambda record: tuple(getter(record) for getter in getters)
 
-    # Perform sorts from least priority to most priority
-    if records and len(records) > 0 and sorts and len(sorts) > 0:
-        reversed_sorts = sorts[:]  # Don't introduce unexpected side-effects by mutating input list of sorts
-        reversed_sorts.reverse()
 
-        for sort in reversed_sorts:
-            bad_sort_error = f'Fatal error, {sort} is an invalid sort.'
+def _descending_column(values: List[Any], numeric: bool) -> List[Any]:
+    """Map a column's sort values to integers that order in reverse when sorted ascending."""
+    if numeric:
+        return [-value for value in values]
+    # Strings can't be negated, rank the distinct values once and negate the rank instead
+    ranks = {value: rank for rank, value in enumerate(sorted(set(values)))}
+    return [-ranks[value] for value in values]
 
-            if sort.count(',') != 1:
-                raise ValueError(bad_sort_error)
 
-            col_number, direction = sort.split(',')
-            if not col_number.isdigit() or direction.lower() not in ["asc", "desc"]:
-                raise ValueError(bad_sort_error)
+def format_sorts(specs: List[Tuple[int, bool]]) -> str:
+    """Format parsed sorts back to sorts such as '3,DESC 0,ASC', space separated."""
+    return ' '.join(f'{col_number},{"DESC" if desc else "ASC"}' for col_number, desc in specs)
+
+
+def sort_label(specs: List[Tuple[int, bool]]) -> str:
+    """Format parsed sorts as a metrics label, at most one sort per column so clients can't make labels unbounded."""
+    return format_sorts(distinct_sorts(specs))
+
+
+def sort_order(records: List[Record], specs: List[Tuple[int, bool]], engine: str = 'auto',
+               collation: str = 'ordinal') -> List[int]:
+    """Return the positions of records in the stable order given by parsed sorts, comparing strings in collation.
+
+    engine is 'python', 'numpy' for the vectorized domain.columnar engine, or 'auto' to use NumPy for multi-column and
+    date sorts of at least COLUMNAR_THRESHOLD records. A single string column sorts as fast or faster in Python when
+    its values are mostly distinct. Either way the order is the same, and without NumPy installed Python is used.
+    """
+    if not metrics.enabled:
+        return _sort_order(records, specs, engine, collation)
+    with metrics.timer('records_sort_seconds', sort=sort_label(specs)):
+        return _sort_order(records, specs, engine, collation)
+
+
+def _sort_order(records: List[Record], specs: List[Tuple[int, bool]], engine: str, collation: str) -> List[int]:
+    """Return the positions of records in the stable order given by parsed sorts, see sort_order."""
+    if not specs:
+        return list(range(len(records)))
+
+    if engine not in SORT_ENGINES:
+        raise ValueError(f'Fatal error, {engine} is not a sort engine.')
+    collate = collation_key(collation)
+    vectorizable = len(specs) > 1 or specs[0][0] == DATE_OF_BIRTH_COLUMN
+    if engine == 'numpy' or (engine == 'auto' and vectorizable and len(records) >= COLUMNAR_THRESHOLD):
+        # Imported here, loading NumPy takes longer than most command line runs take to sort
+        from domain import columnar
+        if columnar.numpy is not None:
+            return columnar.columnar_sort_order(records, specs, collate)
+        if engine == 'numpy':
+            logger.warning('numpy is not installed, sorting without it')
+
+    # Every spec sharing one direction needs no key rewriting, a reversed stable sort keeps ties in input order
+    descending = {desc for _, desc in specs}
+    reverse = descending == {True}
+
+    columns = []
+    for col_number, desc in specs:
+        values = list(map(column_getter(col_number), records))
+        numeric = col_number == DATE_OF_BIRTH_COLUMN
+        if collate is not None and not numeric:
+            # Collation keys are usually longer than the strings, small integer ranks compare faster
+            values, numeric = collation_ranks(values, collate), True
+        if desc and not reverse:
+            values = _descending_column(values, numeric)
+        columns.append(values)
+
+    keys = columns[0] if len(columns) == 1 else list(zip(*columns))
+    return sorted(range(len(records)), key=keys.__getitem__, reverse=reverse)
+
+
+def top_records(records: Iterable[Record], specs: List[Tuple[int, bool]], limit: int,
+                collation: str = 'ordinal') -> List[Record]:
+    """Return the first limit records in the stable order given by parsed sorts in collation, holding at most limit.
+
+    Records are consumed once through a bounded heap, O(n log limit) time and O(limit) memory, so any iterable works.
+    Selections are timed like sort_order when metrics are on, including the time taken to produce lazy records.
+    """
+    if not metrics.enabled:
+        return _top_records(records, specs, limit, collation)
+    with metrics.timer('records_sort_seconds', sort=sort_label(specs)):
+        return _top_records(records, specs, limit, collation)
+
+
+def _top_records(records: Iterable[Record], specs: List[Tuple[int, bool]], limit: int,
+                 collation: str) -> List[Record]:
+    """Return the first limit records in the stable order given by parsed sorts, see top_records."""
+    if not specs:
+        return list(islice(records, limit))
+
+    descending = {desc for _, desc in specs}
+    if len(descending) == 1 and collation_key(collation) is None:
+        # One direction compares plain attributes, nlargest keeps ties in input order like a reversed stable sort
+        key = attrgetter(*[_sort_attribute(col_number) for col_number, _ in specs])
+        select = heapq.nlargest if descending == {True} else heapq.nsmallest
+        return select(limit, records, key=key)
+    return heapq.nsmallest(limit, records, key=record_sort_key(specs, collation))
+
+
+def merge_sorted_records(sequences: List[Iterable[Record]], specs: List[Tuple[int, bool]],
+                         collation: str = 'ordinal') -> Iterator[Record]:
+    """Lazily merge sequences of records, each already in the order of parsed sorts, ties kept in sequence order."""
+    descending = {desc for _, desc in specs}
+    if len(descending) == 1 and collation_key(collation) is None:
+        # One direction compares plain attributes, a reversed merge keeps ties in sequence order too
+        key = attrgetter(*[_sort_attribute(col_number) for col_number, _ in specs])
+        return heapq.merge(*sequences, key=key, reverse=descending == {True})
+    return heapq.merge(*sequences, key=record_sort_key(specs, collation))
+
+
+def read_top_records(files: List[str], sorts: Optional[List[str]], limit: int,
+                     collation: str = 'ordinal') -> List[Record]:
+    """Return the first limit records of files in the order of sorts, without holding more than limit per file.
+
+    Equivalent to sorting read_records and keeping the first limit, including skipping every record of a malformed
+    file, so records are selected per file and only merged with earlier files' selection once a file parsed cleanly.
+    """
+    specs = parse_sorts(sorts) if sorts else []
+    selected = []
+    for file in files:
+        fmt = record_file_type(file)
+        if fmt is None:
+            continue
+
+        try:
+            file_selected = top_records(parse_counted_record_file(file, fmt), specs, limit, collation)
+        except PARSE_ERRORS:
+            report_malformed_file(file)
+            continue
+        selected = top_records(selected + file_selected, specs, limit, collation)
+    return selected
+
 
-            col_number = int(col_number)
-            direction = direction.lower()
+def sort_records(records: List[Record], sorts: List[str], engine: str = 'auto', limit: Optional[int] = None,
+                 collation: str = 'ordinal') -> Optional[List[Record]]:
+    """Sorts records and returns a new list, holding only the first limit records when limit is given.
 
-            if col_number < 0 or col_number >= len(records[0]):
-                raise ValueError(f'Fatal error, {col_number} is not an in-range column number.')
+    A limit well below the number of records is selected with a bounded heap rather than a full sort. Strings compare
+    in code point order by default, so 'Zed' sorts before 'alpha', pick another collation for case-insensitive or
+    locale order.
+    """
+    if not records or not sorts:
+        return records if limit is None else records[:limit]
 
-            sorted_records = sorted(sorted_records, key=lambda record: column_value_for_sort(record, col_number),
-                                    reverse=True if direction == "desc" else False)
-    return sorted_records
+    specs = parse_sorts(sorts, len(records[0]))
+    if limit is not None and limit * TOP_K_RATIO < len(records):
+        return top_records(records, specs, limit, collation)
+    order = sort_order(records, specs, engine, collation)
+    return [records[i] for i in order[:limit]]
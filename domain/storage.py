@@ -0,0 +1,205 @@
+"""Storage backends for the API's record store."""
+import mmap
+import os
+import tempfile
+from array import array
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Optional, Union
+
+from models.record import RECORD_COLUMNS, Record
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - no cross process locking without fcntl, run a single writer
+    fcntl = None
+
+STRING_COLUMNS = RECORD_COLUMNS[:-1]
+
+
+class MemoryBackend(list):
+    """Records held in a list for the lifetime of the process, the default backend."""
+
+    def refresh(self) -> int:
+        """Return the number of records, nothing else can write to this backend."""
+        return len(self)
+
+    def load_positions(self, name: str) -> None:
+        """Return None, nothing outlives this backend for an index to have been persisted in."""
+        return None
+
+    def save_positions(self, name: str, positions: array):
+        """Do nothing, indexes of records held in memory are rebuilt along with the records."""
+
+
+class _MappedFile:
+    """A read-only memory map of a file that may grow, empty files map to an empty buffer."""
+
+    def __init__(self, path: Path, size: Optional[int] = None):
+        """Map the first size bytes of the file at path, all of the file as opened by default."""
+        self.path = path
+        self._map = None
+        self.view = memoryview(b'')
+        # The map holds its own handle on the file
+        with path.open('rb') as in_stream:
+            self.size = os.fstat(in_stream.fileno()).st_size if size is None else size
+            if self.size:
+                self._map = mmap.mmap(in_stream.fileno(), self.size, access=mmap.ACCESS_READ)
+        if self._map is not None:
+            self.view = memoryview(self._map)
+
+    def cast(self, fmt: str) -> memoryview:
+        """Return a typed view of the whole mapping."""
+        return self.view.cast(fmt) if self.size else memoryview(array(fmt))
+
+
+class _Mapping(NamedTuple):
+    """Every column mapped up to a record count, an immutable snapshot of a record directory."""
+
+    count: int
+    offsets: List[memoryview]
+    strings: List[memoryview]
+    dates: memoryview
+
+    @classmethod
+    def of(cls, path: Path, count: int) -> '_Mapping':
+        """Map the first count records of the record directory at path."""
+        offsets, strings = [], []
+        for column in STRING_COLUMNS:
+            offsets.append(_MappedFile(path / f'{column}.off', count * 8).cast('Q'))
+            strings.append(_MappedFile(path / f'{column}.str', offsets[-1][count - 1] if count else 0).view)
+        return cls(count, offsets, strings, _MappedFile(path / 'date_of_birth.i32', count * 4).cast('i'))
+
+    def release(self):
+        """Release every view, unmapping the files once nothing else references them."""
+        for view in self.offsets + self.strings + [self.dates]:
+            view.release()
+
+
+class MmapBackend:
+    """Append-only columnar record files, memory-mapped so restarts and other processes read them without parsing.
+
+    A directory holds, per string column, a <column>.str file of concatenated UTF-8 values and a <column>.off offset
+    index of native uint64 end offsets, plus a date_of_birth.i32 file of native int32 date ordinals. The date file is
+    written last for every append, so its length is the committed record count: a reader never sees a partially
+    written record and a writer that crashed part way is rolled back by the next append. Appends take an exclusive
+    lock, so several API worker processes can share a directory. Files use native byte order and aren't fsynced, so
+    they survive process restarts and crashes but not necessarily a power loss.
+
+    A refresh maps the grown files afresh and swaps the new mapping in whole, leaving the old one to be unmapped once
+    no reader still holds it, so threads can read while another refreshes.
+
+    A RecordStore's sorted indexes are persisted alongside the columns, each as a <name>.idx file of native uint64
+    record positions in the index's order. They cover a prefix of the records, which are never replaced in this
+    backend, so a saved index stays valid as records are appended and is only ever replaced whole. Stores map them
+    when opened rather than decoding the records they cover. Every access to a record decodes a new Record from the
+    maps.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        """Open, creating if needed, a record directory at path."""
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        for column in STRING_COLUMNS:
+            (self.path / f'{column}.str').touch()
+            (self.path / f'{column}.off').touch()
+        self._dates_path = self.path / 'date_of_birth.i32'
+        self._dates_path.touch()
+        self._lock_path = self.path / 'lock'
+        self._lock_path.touch()
+
+        self._mapping = _Mapping.of(self.path, 0)
+        self.refresh()
+
+    def refresh(self) -> int:
+        """Map records appended since the last refresh, by this or any other process, and return the count."""
+        count = self._dates_path.stat().st_size // 4
+        if count != self._mapping.count:
+            self._mapping = _Mapping.of(self.path, count)
+        return count
+
+    def close(self):
+        """Release the backend's memory maps, it can't be read from afterwards."""
+        self._mapping.release()
+
+    def load_positions(self, name: str) -> Optional[memoryview]:
+        """Map the positions of the index persisted as name, None when there isn't one."""
+        try:
+            return _MappedFile(self.path / f'{name}.idx').cast('Q')
+        except FileNotFoundError:
+            return None
+
+    def save_positions(self, name: str, positions: array):
+        """Persist the uint64 positions of an index as name, replacing any saved before all at once.
+
+        Maps of the replaced file keep reading it, so other processes can save the same index meanwhile.
+        """
+        with tempfile.NamedTemporaryFile(dir=self.path, prefix=f'{name}.', suffix='.tmp', delete=False) as out_stream:
+            out_stream.write(positions.tobytes())
+        os.replace(out_stream.name, self.path / f'{name}.idx')
+
+    def __len__(self):
+        """Return the number of records as of the last refresh."""
+        return self._mapping.count
+
+    @staticmethod
+    def _record(mapping: _Mapping, i: int) -> Record:
+        """Decode the record at position i straight from the mapped columns."""
+        values = []
+        for offsets, strings in zip(mapping.offsets, mapping.strings):
+            start = offsets[i - 1] if i else 0
+            values.append(str(strings[start:offsets[i]], 'utf-8'))
+        return Record.from_ordinal(*values, mapping.dates[i])
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[Record, List[Record]]:
+        """Return the record at a position, or a list of records for a slice."""
+        mapping = self._mapping
+        if isinstance(i, slice):
+            return [self._record(mapping, position) for position in range(*i.indices(mapping.count))]
+        if i < 0:
+            i += mapping.count
+        if not 0 <= i < mapping.count:
+            raise IndexError('record position out of range')
+        return self._record(mapping, i)
+
+    def __iter__(self) -> Iterator[Record]:
+        """Iterate the records mapped when called, in insertion order."""
+        mapping = self._mapping
+        return (self._record(mapping, i) for i in range(mapping.count))
+
+    def append(self, record: Record):
+        """Append a record."""
+        self.extend([record])
+
+    def extend(self, records: List[Record]):
+        """Append a batch of records, visible to readers all at once."""
+        with self._lock_path.open('rb') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            count = self._dates_path.stat().st_size // 4
+
+            for column in STRING_COLUMNS:
+                with (self.path / f'{column}.off').open('r+b') as offsets_stream, \
+                        (self.path / f'{column}.str').open('r+b') as strings_stream:
+                    # Roll back anything past the committed count left by a writer that crashed part way
+                    offsets_stream.truncate(count * 8)
+                    end = 0
+                    if count:
+                        offsets_stream.seek((count - 1) * 8)
+                        end = array('Q', offsets_stream.read(8))[0]
+                    strings_stream.truncate(end)
+
+                    encoded = [getattr(record, column).encode('utf-8') for record in records]
+                    offsets = array('Q')
+                    for value in encoded:
+                        end += len(value)
+                        offsets.append(end)
+                    strings_stream.seek(0, os.SEEK_END)
+                    strings_stream.write(b''.join(encoded))
+                    offsets_stream.seek(0, os.SEEK_END)
+                    offsets_stream.write(offsets.tobytes())
+
+            # Commit point, readers derive the record count from this file
+            with self._dates_path.open('r+b') as dates_stream:
+                dates_stream.truncate(count * 4)
+                dates_stream.seek(0, os.SEEK_END)
+                dates_stream.write(array('i', [record.date_of_birth_ordinal for record in records]).tobytes())
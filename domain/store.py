@@ -0,0 +1,543 @@
+"""Record storage for the API, with sorted indexes so sorted reads don't re-sort every request."""
+import locale
+import os
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import islice
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, Sequence, Tuple, Union
+
+from domain import metrics
+from domain.collation import collation_key
+from domain.record import TOP_K_RATIO, filter_predicate, parse_filters, parse_sorts, record_identity, record_sort_key, \
+    sort_label, sort_order, top_records
+from domain.storage import MemoryBackend, MmapBackend
+from models.record import Record
+
+# Batches at least this large are merged into indexes in one pass instead of inserted record by record
+BULK_MERGE_THRESHOLD = 64
+# Sort orderings beyond the fixed endpoint ones kept cached, least recently used are evicted first
+SORT_CACHE_SIZE = 32
+# Kept indexes are persisted by backends that can once they cover this many records not yet persisted, and again
+# whenever they grow by a further 1/INDEX_PERSIST_GROWTH, so a store reopened after a crash has few records to index
+INDEX_PERSIST_MIN_RECORDS = 4096
+INDEX_PERSIST_GROWTH = 8
+
+# Index names for sorts that aren't expressible as column sorts
+NAME_INDEX = 'name'
+
+SortSpecs = Tuple[Tuple[int, bool], ...]
+
+
+def name_sort_key(record: Record) -> str:
+    """Return the '[First] [Last]' name key records are sorted by."""
+    return f'{record.first_name} {record.last_name}'
+
+
+class SortedIndex:
+    """Positions of a store's records in the order of a sort key, ties kept in insertion order.
+
+    Only positions are held, keys are decoded from the store's backend for just the records a search compares. So an
+    index can be the memory map of positions a backend persisted, which is only copied into memory once it's changed.
+    """
+
+    def __init__(self, key: Callable[[Record], Any], records: Union[MemoryBackend, MmapBackend], count: int = 0,
+                 positions: Optional[Sequence[int]] = None):
+        """Index the first count records of a backend by key, or take positions of them already in key order."""
+        self.key = key
+        self._records = records
+        if positions is None:
+            keys = [key(record) for record in records[:count]]
+            positions = array('Q', sorted(range(len(keys)), key=keys.__getitem__))
+        self.positions = positions
+
+    def __len__(self):
+        """Return the number of records indexed, a prefix of the store's records."""
+        return len(self.positions)
+
+    def _key_at(self, at: int) -> Any:
+        """Decode the key of the record at a place in the index."""
+        return self.key(self._records[self.positions[at]])
+
+    def bisect_left(self, key: Any, lo: int = 0, hi: Optional[int] = None) -> int:
+        """Return where key goes among the indexed records, before any with an equal key."""
+        hi = len(self.positions) if hi is None else hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def bisect_right(self, key: Any, lo: int = 0, hi: Optional[int] = None) -> int:
+        """Return where key goes among the indexed records, after any with an equal key."""
+        hi = len(self.positions) if hi is None else hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key < self._key_at(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def _writable(self) -> array:
+        """Return the positions as an array that can be changed, copying a persisted map of them the first time."""
+        if not isinstance(self.positions, array):
+            self.positions = array('Q', self.positions.tobytes())
+        return self.positions
+
+    def add(self, record: Record, position: int):
+        """Insert a record added to the store at position, after any records with an equal key."""
+        insert_at = self.bisect_right(self.key(record))
+        self._writable().insert(insert_at, position)
+
+    def extend(self, records: List[Record], first_position: int):
+        """Add a batch of records added to the store from first_position onwards, merging large batches at once."""
+        if len(records) < BULK_MERGE_THRESHOLD:
+            for position, record in enumerate(records, first_position):
+                self.add(record, position)
+            return
+
+        batch = sorted(zip(map(self.key, records), range(first_position, first_position + len(records))))
+        # Batch records go after indexed records with equal keys, so each is searched for only past the one before
+        positions, merged, start = self._writable(), array('Q'), 0
+        for key, position in batch:
+            at = self.bisect_right(key, start)
+            merged.extend(positions[start:at])
+            merged.append(position)
+            start = at
+        merged.extend(positions[start:])
+        self.positions = merged
+
+    def replace(self, old: Record, new: Record, position: int):
+        """Move the record at position, to be replaced in the store by new, to where new sorts, ties in position order.
+
+        Searching decodes old from the store, so call this before replacing it there. Readers not holding the store's
+        lock may briefly find the record missing from the ordering, never repeated.
+        """
+        positions = self._writable()
+        # Equal keys hold ascending positions, so position bisects among them
+        key = self.key(old)
+        old_at = bisect_left(positions, position, self.bisect_left(key), self.bisect_right(key))
+        if old_at == len(positions) or positions[old_at] != position:
+            raise RuntimeError(f'Fatal error, the record at {position} is not indexed by its key.')
+        del positions[old_at]
+        key = self.key(new)
+        positions.insert(bisect_left(positions, position, self.bisect_left(key), self.bisect_right(key)), position)
+
+
+class RecordPage:
+    """A page of a store's records at a slice of positions, each record read from the backend only when accessed.
+
+    Streaming a page reads it a batch at a time, so a persistent backend decodes records as they're sent rather than
+    the whole page up front.
+    """
+
+    def __init__(self, records: Union[MemoryBackend, MmapBackend], positions: Sequence[int]):
+        """Page the records at positions of a backend."""
+        self._records = records
+        self._positions = positions
+
+    def __len__(self):
+        """Return the number of records on the page."""
+        return len(self._positions)
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[Record, List[Record]]:
+        """Return the record at a page index, or a list of records for a slice of the page."""
+        if isinstance(i, slice):
+            return [self._records[position] for position in self._positions[i]]
+        return self._records[self._positions[i]]
+
+    def __iter__(self) -> Iterator[Record]:
+        """Iterate the page's records, reading each as it's reached."""
+        return map(self._records.__getitem__, self._positions)
+
+    def __eq__(self, other) -> bool:
+        """Compare equal to any sequence of the same records."""
+        return list(self) == list(other)
+
+
+def _prefix_upper_bound(prefix: str) -> Optional[str]:
+    """Return the smallest string greater than every string starting with prefix, None when there isn't one."""
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def filter_span(index: SortedIndex, operator: str, value: Any) -> Tuple[int, int]:
+    """Return the start and end, within a single column ascending index, of the positions matching a filter."""
+    key = (value,)
+    if operator == 'eq':
+        return index.bisect_left(key), index.bisect_right(key)
+    if operator == 'prefix':
+        upper = _prefix_upper_bound(value)
+        return index.bisect_left(key), len(index) if upper is None else index.bisect_left((upper,))
+    if operator == 'lt':
+        return 0, index.bisect_left(key)
+    if operator == 'le':
+        return 0, index.bisect_right(key)
+    if operator == 'gt':
+        return index.bisect_right(key), len(index)
+    return index.bisect_left(key), len(index)
+
+
+def _sorted_index(specs: SortSpecs, records: Union[MemoryBackend, MmapBackend], count: int,
+                  collation: str = 'ordinal') -> SortedIndex:
+    """Build the index of the first count records for parsed sorts in collation, timed by spec when metrics are on."""
+    if not metrics.enabled:
+        return SortedIndex(record_sort_key(specs, collation), records, count)
+    with metrics.timer('records_sort_seconds', sort=sort_label(specs)):
+        return SortedIndex(record_sort_key(specs, collation), records, count)
+
+
+def _persisted_name(name: Hashable, collation: str) -> str:
+    """Return the name a backend persists a kept index as, distinct for every sort key and collation."""
+    if name == NAME_INDEX:
+        label = 'name'
+    elif name[0] == 'filter':
+        return f'filter-{name[1]}.ordinal'
+    else:
+        label = 'sort-' + '-'.join(f'{col_number}{"d" if desc else "a"}' for col_number, desc in name)
+    if collation == 'locale':
+        # Locale keys depend on LC_COLLATE, which other processes may set differently
+        collation = 'locale-' + locale.setlocale(locale.LC_COLLATE).replace(os.sep, '_')
+    return f'{label}.{collation}'
+
+
+class SortedResultCache:
+    """Bounded LRU of sort orderings keyed by normalized sort specs.
+
+    The store only appends, or replaces records in place through replace, so the number of records an ordering covers
+    is its version. A cached ordering behind the store is patched with just the records added since, rather than
+    rebuilt. Callers hold the store's lock for every method, look an ordering up, and on a miss sort it without the
+    lock before caching it with insert.
+    """
+
+    def __init__(self, max_entries: int = SORT_CACHE_SIZE, collation: str = 'ordinal'):
+        """Create an empty cache holding at most max_entries orderings, comparing strings in collation."""
+        self.max_entries = max_entries
+        self.collation = collation
+        self._entries: 'OrderedDict[SortSpecs, SortedIndex]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.patches = 0
+        self.evictions = 0
+
+    def __len__(self):
+        """Return the number of cached orderings."""
+        return len(self._entries)
+
+    def __contains__(self, specs: SortSpecs) -> bool:
+        """Return whether an ordering for specs is cached."""
+        return specs in self._entries
+
+    def lookup(self, specs: SortSpecs, records: List[Record]) -> Optional[SortedIndex]:
+        """Return the cached ordering for specs patched up to date with records, None on a miss."""
+        index = self._entries.get(specs)
+        if index is None:
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(specs)
+        if len(index) < len(records):
+            self.patches += 1
+            index.extend(records[len(index):], len(index))
+        return index
+
+    def insert(self, specs: SortSpecs, index: SortedIndex, records: List[Record]) -> SortedIndex:
+        """Cache an ordering built on a miss, patched up to date with records, evicting the least recently used.
+
+        When another caller cached specs while this index was being built, the cached ordering is kept instead.
+        """
+        self.misses += 1
+        index = self._entries.setdefault(specs, index)
+        self._entries.move_to_end(specs)
+        if len(index) < len(records):
+            index.extend(records[len(index):], len(index))
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return index
+
+    def replace(self, old: Record, new: Record, position: int):
+        """Move a record replaced at position within every cached ordering that covers it."""
+        for index in self._entries.values():
+            if position < len(index):
+                index.replace(old, new, position)
+
+    def stats(self) -> Dict[str, int]:
+        """Return hit, miss, patch and eviction counters along with the current size."""
+        return {'hits': self.hits, 'misses': self.misses, 'patches': self.patches, 'evictions': self.evictions,
+                'size': len(self)}
+
+
+class RecordStore:
+    """Holds records in a storage backend, along with sorted indexes of them, safe to share between threads.
+
+    Indexes for the name sort and each column sort used by a fixed endpoint, and ascending indexes of any column a
+    filter was used on, are kept: built when first read, or mapped from a backend that persisted them, and updated on
+    every add from then on. Any other sort is served from a SortedResultCache. The first read of a small page of a
+    sort that isn't indexed selects it with a bounded heap instead, the sort is only cached when read again. Records
+    other processes append to a shared backend are picked up, and indexed, by the next read or write. Sorts compare
+    strings in the store's collation, while filters always match exact strings. With key columns, a hash index maps
+    each key to its first record's position so records can be upserted, built by the first upsert.
+
+    Records are only appended, except by upserts, so the first count records are a snapshot versioned by count and
+    by the generation, which upserts advance whenever they replace records. An index built from a snapshot replaced
+    in meanwhile is rebuilt before it's published. Writes and index updates are serialized by a lock. Reads hold it
+    only to sync and to look up an ordering, and do their sorting, selection and decoding on a snapshot outside of it.
+    Pages are read lock free: index positions are only ever changed by single array operations or by replacing their
+    arrays, which are atomic for readers.
+    """
+
+    def __init__(self, backend: Optional[Union[MemoryBackend, MmapBackend]] = None,
+                 sort_cache_size: int = SORT_CACHE_SIZE, collation: str = 'ordinal',
+                 key_columns: Optional[Tuple[int, ...]] = None):
+        """Create a store over backend, in memory by default, reading none of the records it already holds.
+
+        With key_columns, records are also hashed by those columns so they can be upserted.
+        """
+        collate = collation_key(collation)
+        self.collation = collation
+        self._records = MemoryBackend() if backend is None else backend
+        self._lock = threading.RLock()
+        name_key = name_sort_key if collate is None else lambda record: collate(name_sort_key(record))
+        # Sort keys of the indexes kept once built, filtered columns are added as they're first filtered on
+        self._index_keys: Dict[Hashable, Callable[[Record], Any]] = {NAME_INDEX: name_key}
+        for specs in (((2, False),), ((4, False),)):
+            self._index_keys[specs] = record_sort_key(specs, collation)
+        self._indexes: Dict[Hashable, SortedIndex] = {}
+        # The number of records each kept index covered when it was last persisted, or mapped from the backend
+        self._persisted: Dict[Hashable, int] = {}
+        self.sort_cache = SortedResultCache(sort_cache_size, collation)
+        # Sorts read once with a bounded heap, least recently read first, so a second read caches their ordering
+        self._top_k_sorts: 'OrderedDict[SortSpecs, None]' = OrderedDict()
+        # Position of the first stored record with each key, covering the first _keyed records
+        self.key_columns = key_columns
+        self._identity = record_identity(key_columns) if key_columns else None
+        self._positions_by_key: Dict[Hashable, int] = {}
+        self._keyed = 0
+        # Advanced by every upsert that replaces records, snapshots taken before then may hold replaced records
+        self._generation = 0
+
+    def __len__(self):
+        """Return the number of stored records."""
+        return self._sync()
+
+    def __iter__(self) -> Iterator[Record]:
+        """Iterate the records stored when called, in insertion order."""
+        return islice(iter(self._records), self._sync())
+
+    def _sync(self) -> int:
+        """Bring kept indexes up to date with records appended to the backend, returning the record count."""
+        with self._lock:
+            count = self._records.refresh()
+            for name, index in self._indexes.items():
+                if len(index) < count:
+                    index.extend(self._records[len(index):count], len(index))
+                persisted = self._persisted[name]
+                if len(index) - persisted >= max(INDEX_PERSIST_MIN_RECORDS, persisted // INDEX_PERSIST_GROWTH):
+                    self._persist(name, index)
+            return count
+
+    def _persist(self, name: Hashable, index: SortedIndex):
+        """Persist a kept index's positions in the backend, if it keeps them, while holding the lock."""
+        self._records.save_positions(_persisted_name(name, self.collation), index.positions)
+        self._persisted[name] = len(index)
+
+    def persist_indexes(self):
+        """Persist every kept index not persisted up to date, so stores opened over the backend next map them."""
+        with self._lock:
+            self._sync()
+            for name, index in self._indexes.items():
+                if len(index) > self._persisted[name]:
+                    self._persist(name, index)
+
+    def _hash_keys(self, records: List[Record], first_position: int):
+        """Add the keys of records stored from first_position onwards to the hash index."""
+        for position, record in enumerate(records, first_position):
+            self._positions_by_key.setdefault(self._identity(record), position)
+        self._keyed = first_position + len(records)
+
+    def add(self, record: Record):
+        """Store a record and update every kept index."""
+        with self._lock:
+            self._records.append(record)
+            self._sync()
+
+    def extend(self, records: List[Record]):
+        """Store a batch of records, updating each kept index once for the whole batch."""
+        with self._lock:
+            self._records.extend(records)
+            self._sync()
+
+    def upsert(self, record: Record) -> bool:
+        """Store a record, replacing any stored record with the same key in place, returning whether it replaced one."""
+        return self.upsert_many([record])[1] == 1
+
+    def upsert_many(self, records: List[Record]) -> Tuple[int, int]:
+        """Store a batch of records, replacing stored records with the same keys, returning (inserted, replaced).
+
+        Both counts are of distinct keys, however often a key repeats in the batch. A key is found through the hash
+        index in O(1), and a replaced record is moved within every index, kept and cached, rather than re-indexed.
+        Later records in the batch replace earlier ones with the same key. Replacing in place means reads running
+        meanwhile may see either record. Needs key columns and a backend records can be replaced in, the in memory
+        one.
+        """
+        if self._identity is None:
+            raise ValueError('Fatal error, upserts need a store with key columns.')
+        if not hasattr(self._records, '__setitem__'):
+            raise ValueError('Fatal error, records can not be replaced in this storage backend.')
+
+        with self._lock:
+            count = self._sync()
+            # Hash the records stored since the last upsert, or every record on the first
+            self._hash_keys(self._records[self._keyed:count], self._keyed)
+            inserts: Dict[Hashable, Record] = {}
+            replaced = set()
+            for record in records:
+                key = self._identity(record)
+                position = self._positions_by_key.get(key)
+                if position is None:
+                    inserts[key] = record
+                    continue
+                old = self._records[position]
+                for index in self._indexes.values():
+                    index.replace(old, record, position)
+                self.sort_cache.replace(old, record, position)
+                self._records[position] = record
+                replaced.add(position)
+            if replaced:
+                self._generation += 1
+            self._records.extend(inserts.values())
+            self._sync()
+            return len(inserts), len(replaced)
+
+    def _kept_index(self, name: Hashable, count: int) -> SortedIndex:
+        """Return a kept index, mapping it from the backend or else building it from a snapshot the first time."""
+        index = self._indexes.get(name)
+        if index is not None:
+            return index
+        key = self._index_keys[name]
+        generation = self._generation
+        positions = self._records.load_positions(_persisted_name(name, self.collation))
+        if positions is not None and len(positions) <= count:
+            index = SortedIndex(key, self._records, positions=positions)
+        else:
+            index = SortedIndex(key, self._records, count)
+        with self._lock:
+            if generation != self._generation and name not in self._indexes:
+                # Records were replaced while indexing, the index may hold their old keys
+                index = SortedIndex(key, self._records, count)
+            if self._indexes.setdefault(name, index) is index:
+                self._persisted[name] = len(index) if index.positions is positions else 0
+            self._sync()
+            return self._indexes[name]
+
+    def _index_for(self, specs: SortSpecs, count: int) -> SortedIndex:
+        """Return the ordering for parsed sorts from a kept index or the sort cache, sorting a snapshot on a miss."""
+        if specs in self._index_keys:
+            return self._kept_index(specs, count)
+        with self._lock:
+            index = self.sort_cache.lookup(specs, self._records)
+            generation = self._generation
+        if index is not None:
+            return index
+        index = _sorted_index(specs, self._records, count, self.collation)
+        with self._lock:
+            if generation != self._generation and specs not in self.sort_cache:
+                # Records were replaced while sorting, the index may hold their old keys
+                index = _sorted_index(specs, self._records, count, self.collation)
+            return self.sort_cache.insert(specs, index, self._records)
+
+    def _column_index(self, col_number: int, count: int) -> SortedIndex:
+        """Return an exact ascending index of a column, kept up to date from when it's first needed."""
+        specs = ((col_number, False),)
+        # The same index serves sorts by the column when they compare exact strings too
+        name = specs if collation_key(self.collation) is None else ('filter', col_number)
+        self._index_keys.setdefault(name, record_sort_key(specs))
+        return self._kept_index(name, count)
+
+    def _page(self, positions: Sequence[int], offset: int, limit: Optional[int]) -> RecordPage:
+        """Return the page of records at positions, reading none of them until the page is accessed."""
+        end = None if limit is None else offset + limit
+        return RecordPage(self._records, positions[offset:end])
+
+    def _indexed_page(self, index: SortedIndex, offset: int, limit: Optional[int]) -> Tuple[RecordPage, int]:
+        """Return a page of an index's records along with the count indexed, which other writers may have added to."""
+        page = self._page(index.positions, offset, limit)
+        # Counted after the page was read, indexes only grow, so the page never holds more records than the count
+        return page, len(index)
+
+    def sorted(self, sorts: Optional[List[str]], offset: int = 0,
+               limit: Optional[int] = None) -> Tuple[Sequence[Record], int]:
+        """Return a page of records in the order of sorts, like sort_records, along with the count of stored records.
+
+        Pages read from an index or in insertion order are RecordPages, read as they're accessed.
+        """
+        count = self._sync()
+        if not count or not sorts:
+            return self._page(range(count), offset, limit), count
+
+        specs = tuple(parse_sorts(sorts))
+        if limit is not None and (offset + limit) * TOP_K_RATIO < count and self._first_read(specs):
+            selected = top_records(islice(iter(self._records), count), list(specs), offset + limit, self.collation)
+            return selected[offset:], count
+        return self._indexed_page(self._index_for(specs, count), offset, limit)
+
+    def _first_read(self, specs: SortSpecs) -> bool:
+        """Return whether specs has no ordering yet and hasn't been read recently, noting that it now has been."""
+        with self._lock:
+            if specs in self._index_keys or specs in self.sort_cache:
+                return False
+            if specs in self._top_k_sorts:
+                del self._top_k_sorts[specs]
+                return False
+            self._top_k_sorts[specs] = None
+            if len(self._top_k_sorts) > self.sort_cache.max_entries:
+                self._top_k_sorts.popitem(last=False)
+            return True
+
+    def sorted_by_name(self, offset: int = 0, limit: Optional[int] = None) -> Tuple[RecordPage, int]:
+        """Return a page of records sorted by '[First] [Last]' name, along with the count of stored records."""
+        count = self._sync()
+        return self._indexed_page(self._kept_index(NAME_INDEX, count), offset, limit)
+
+    def filtered(self, filters: List[str], sorts: Optional[List[str]] = None, offset: int = 0,
+                 limit: Optional[int] = None) -> Tuple[Sequence[Record], int]:
+        """Return a page of the records matching every filter in the order of sorts, along with the match count.
+
+        The most selective filter's span of its column index gives the candidates, so only they are read, checked
+        against the other filters and sorted. Matches keep insertion order when there are no sorts.
+        """
+        count = self._sync()
+        parsed = parse_filters(filters)
+        specs = parse_sorts(sorts) if sorts else []
+        if not parsed:
+            return self.sorted(sorts, offset, limit)
+
+        indexes = [self._column_index(col_number, count) for col_number, _, _ in parsed]
+        with self._lock:
+            # Keys and positions must agree, writers change them one after the other
+            spans = [filter_span(index, operator, value) for index, (_, operator, value) in zip(indexes, parsed)]
+            narrowest = min(range(len(spans)), key=lambda i: spans[i][1] - spans[i][0])
+            start, stop = spans[narrowest]
+            positions = indexes[narrowest].positions[start:stop]
+        positions = sorted(positions)
+        others = parsed[:narrowest] + parsed[narrowest + 1:]
+        if not others and not specs:
+            # Only the page's records need reading
+            return self._page(positions, offset, limit), len(positions)
+
+        matches = [self._records[position] for position in positions]
+        if others:
+            matches = list(filter(filter_predicate(others), matches))
+        end = None if limit is None else offset + limit
+        if specs and end is not None and end * TOP_K_RATIO < len(matches):
+            return top_records(matches, specs, end, self.collation)[offset:], len(matches)
+        if specs:
+            matches = [matches[i] for i in sort_order(matches, specs, collation=self.collation)]
+        return matches[offset:end], len(matches)
@@ -0,0 +1,161 @@
+"""Compact binary record file format.
+
+A file starts with the magic bytes RBF1 and a layout byte, followed by records in that layout. Integers are little
+endian and dates are stored as int32 proleptic Gregorian ordinals, so reading never re-parses a date.
+
+Row layout: each record is four uint32 string lengths and an int32 date ordinal, followed by the four UTF-8 strings.
+
+Column layout: records are grouped in chunks. Each chunk is a uint32 record count, then for each string column an
+encoding byte and the column's values, then the chunk's int32 date ordinals. Values are one UTF-8 string, preceded by
+its uint32 byte length, with values separated by NUL characters. When a value contains a NUL itself, the encoding byte
+is 1 and the string is preceded by the uint32 code point lengths of each value instead. Whole columns are decoded and
+split at once, which makes this the faster layout to read.
+"""
+import struct
+import sys
+from array import array
+from itertools import accumulate, islice
+from typing import BinaryIO, Iterable, Iterator, List
+
+from models.record import Record
+
+MAGIC = b'RBF1'
+ROW_LAYOUT = 0
+COLUMN_LAYOUT = 1
+# Records per chunk in the column layout
+CHUNK_SIZE = 65536
+
+_ROW_HEADER = struct.Struct('<4Ii')
+_UINT32 = struct.Struct('<I')
+_SEPARATED = 0
+_LENGTH_PREFIXED = 1
+
+
+class BinaryFormatError(ValueError):
+    """Raised when a binary record file is malformed."""
+
+
+def _little_endian(values: array) -> array:
+    """Return values in little endian byte order."""
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+def _read_exactly(in_stream: BinaryIO, size: int) -> bytes:
+    """Read size bytes, raising BinaryFormatError on a truncated file."""
+    data = in_stream.read(size)
+    if len(data) != size:
+        raise BinaryFormatError('binary record file is truncated')
+    return data
+
+
+def _read_array(in_stream: BinaryIO, typecode: str, count: int) -> array:
+    """Read count little endian integers."""
+    values = array(typecode)
+    values.frombytes(_read_exactly(in_stream, count * values.itemsize))
+    return _little_endian(values)
+
+
+def _write_rows(records: Iterable[Record], out_stream: BinaryIO):
+    """Write records in the row layout."""
+    for record in records:
+        strings = [record.last_name.encode('utf-8'), record.first_name.encode('utf-8'),
+                   record.email.encode('utf-8'), record.favorite_color.encode('utf-8')]
+        out_stream.write(_ROW_HEADER.pack(*map(len, strings), record.date_of_birth_ordinal))
+        out_stream.write(b''.join(strings))
+
+
+def _write_chunk(records: List[Record], out_stream: BinaryIO):
+    """Write a chunk of records in the column layout."""
+    out_stream.write(_UINT32.pack(len(records)))
+    for column in ('last_name', 'first_name', 'email', 'favorite_color'):
+        values = [getattr(record, column) for record in records]
+        if any('\0' in value for value in values):
+            out_stream.write(bytes([_LENGTH_PREFIXED]))
+            out_stream.write(_little_endian(array('I', map(len, values))).tobytes())
+            encoded = ''.join(values).encode('utf-8')
+        else:
+            out_stream.write(bytes([_SEPARATED]))
+            encoded = '\0'.join(values).encode('utf-8')
+        out_stream.write(_UINT32.pack(len(encoded)))
+        out_stream.write(encoded)
+    out_stream.write(_little_endian(array('i', [record.date_of_birth_ordinal for record in records])).tobytes())
+
+
+def write_binary_records(records: Iterable[Record], out_stream: BinaryIO, layout: int = COLUMN_LAYOUT):
+    """Write records to a binary stream, holding at most a chunk of them at a time."""
+    out_stream.write(MAGIC + bytes([layout]))
+    if layout == ROW_LAYOUT:
+        _write_rows(records, out_stream)
+        return
+
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, CHUNK_SIZE))
+        if not chunk:
+            return
+        _write_chunk(chunk, out_stream)
+
+
+def _read_rows(in_stream: BinaryIO) -> Iterator[Record]:
+    """Read records in the row layout."""
+    while True:
+        header = in_stream.read(_ROW_HEADER.size)
+        if not header:
+            return
+        if len(header) != _ROW_HEADER.size:
+            raise BinaryFormatError('binary record file is truncated')
+        *lengths, ordinal = _ROW_HEADER.unpack(header)
+        data = _read_exactly(in_stream, sum(lengths))
+        values, start = [], 0
+        for length in lengths:
+            values.append(str(data[start:start + length], 'utf-8'))
+            start += length
+        yield Record.from_ordinal(*values, ordinal)
+
+
+def _read_chunks(in_stream: BinaryIO) -> Iterator[Record]:
+    """Read records in the column layout, a chunk at a time."""
+    while True:
+        header = in_stream.read(_UINT32.size)
+        if not header:
+            return
+        if len(header) != _UINT32.size:
+            raise BinaryFormatError('binary record file is truncated')
+        count, = _UINT32.unpack(header)
+
+        columns = []
+        for _ in range(4):
+            encoding = _read_exactly(in_stream, 1)[0]
+            lengths = _read_array(in_stream, 'I', count) if encoding == _LENGTH_PREFIXED else None
+            size, = _UINT32.unpack(_read_exactly(in_stream, _UINT32.size))
+            text = str(_read_exactly(in_stream, size), 'utf-8')
+            if encoding == _SEPARATED:
+                values = text.split('\0') if count else []
+            elif encoding == _LENGTH_PREFIXED and sum(lengths) == len(text):
+                values = [text[end - length:end] for end, length in zip(accumulate(lengths), lengths)]
+            else:
+                raise BinaryFormatError('binary record column encoding is invalid')
+            if len(values) != count:
+                raise BinaryFormatError('binary record column lengths are inconsistent')
+            columns.append(values)
+        columns.append(_read_array(in_stream, 'i', count))
+        yield from map(Record.from_ordinal, *columns)
+
+
+def read_binary_records(in_stream: BinaryIO) -> Iterator[Record]:
+    """Lazily read the records of a binary stream in either layout, raising BinaryFormatError when malformed."""
+    header = in_stream.read(len(MAGIC) + 1)
+    if not header:
+        return
+    if header[:len(MAGIC)] != MAGIC or len(header) != len(MAGIC) + 1 or header[-1] not in (ROW_LAYOUT, COLUMN_LAYOUT):
+        raise BinaryFormatError('not a binary record file')
+    try:
+        yield from _read_rows(in_stream) if header[-1] == ROW_LAYOUT else _read_chunks(in_stream)
+    except (BinaryFormatError, UnicodeDecodeError):
+        raise
+    except (ValueError, OverflowError) as e:
+        # Out of range date ordinals
+        raise BinaryFormatError(f'binary record file holds an invalid value: {e}') from e
@@ -0,0 +1,53 @@
+"""Date parsing for record models."""
+import re
+from datetime import date
+from functools import lru_cache
+from typing import Callable
+
+# Layouts most exports use, parsed without dateutil. Anything else, including values these patterns match but that
+# dateutil would interpret differently (month > 12 swaps to D/M/YYYY), falls back to dateutil.
+_MONTH_DAY_YEAR = re.compile(r'([0-9]{1,2})([/-])([0-9]{1,2})\2([0-9]{4})')
+_ISO_DATE = re.compile(r'([0-9]{4})-([0-9]{2})-([0-9]{2})')
+
+# Distinct date strings remembered, a few decades of birth dates
+DATE_CACHE_SIZE = 65536
+
+
+def _ignore_fallback():
+    """Do nothing when a date falls back to dateutil, until another layer sets on_fallback."""
+
+
+# Called for every distinct date string parsed by dateutil, domain.record counts these in its metrics
+on_fallback: Callable[[], None] = _ignore_fallback
+
+
+def _parse_fixed_format(date_str: str):
+    """Return a date for the fixed layouts, or None when the string needs dateutil."""
+    match = _MONTH_DAY_YEAR.fullmatch(date_str)
+    if match:
+        month, _, day, year = match.groups()
+    else:
+        match = _ISO_DATE.fullmatch(date_str)
+        if not match:
+            return None
+        year, month, day = match.groups()
+
+    try:
+        return date(int(year), int(month), int(day))
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date_ordinal(date_str: str) -> int:
+    """Parse a date string the way dateutil does and return its proleptic Gregorian ordinal.
+
+    Raises dateutil's ParserError for unparseable dates, like dateutil.parser.parse.
+    """
+    parsed = _parse_fixed_format(date_str) if isinstance(date_str, str) else None
+    if parsed is None:
+        on_fallback()
+        # Imported on first use, most inputs only hold the fixed layouts and never load dateutil
+        from dateutil.parser import parse
+        parsed = parse(date_str)
+    return parsed.toordinal()
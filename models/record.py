@@ -1,10 +1,11 @@
 """Record data models module."""
-from dataclasses import dataclass, field
-from datetime import datetime
+from datetime import date, datetime
 from enum import Enum
-from typing import List
+from functools import lru_cache
+from sys import intern
+from typing import List, Tuple
 
-from dateutil.parser import parse
+from models.dates import parse_date_ordinal
 
 
 class RecordFileType(Enum):
@@ -13,54 +14,113 @@ class RecordFileType(Enum):
     COMMA_SEPARATED = "csv"
     PIPE_SEPARATED = "psv"
     SPACE_SEPARATED = "ssv"
+    BINARY = "rbf"
 
 
+# Delimiters of the text file types, see models.binary for the binary file type
 RecordFileType.delimiters = {
     RecordFileType.COMMA_SEPARATED: ',',
     RecordFileType.PIPE_SEPARATED: '|',
     RecordFileType.SPACE_SEPARATED: ' '
 }
 
+# Column names in positional order, shared by sorting and any other column addressed by number
+RECORD_COLUMNS = ('last_name', 'first_name', 'email', 'favorite_color', 'date_of_birth')
+DATE_OF_BIRTH_COLUMN = RECORD_COLUMNS.index('date_of_birth')
 
-@dataclass
-class Record:
-    """Record data model."""
 
-    last_name: str
-    first_name: str
-    email: str
-    favorite_color: str
-    date_of_birth: datetime
-    _date_of_birth: datetime = field(init=False, repr=False)
+@lru_cache(maxsize=65536)
+def _format_date_ordinal(ordinal: int) -> str:
+    """Format a date ordinal in M/D/YYYY format, records born on the same day share one string."""
+    return date.fromordinal(ordinal).strftime("%m/%d/%Y")
+
+
+class Record:
+    """Record data model.
+
+    Records are slotted and keep the date of birth as an integer ordinal, along with its formatted string, so large
+    collections of them stay compact and positional access doesn't allocate.
+    """
+
+    __slots__ = ('last_name', 'first_name', 'email', 'favorite_color', '_date_of_birth_ordinal', '_date_of_birth')
+
+    def __init__(self, last_name: str, first_name: str, email: str, favorite_color: str, date_of_birth: str):
+        """Create a record, parsing date_of_birth from any format dateutil understands."""
+        self.last_name = intern(last_name)
+        self.first_name = intern(first_name)
+        self.email = email
+        self.favorite_color = intern(favorite_color)
+        self.date_of_birth = date_of_birth
+
+    @classmethod
+    def from_ordinal(cls, last_name: str, first_name: str, email: str, favorite_color: str,
+                     date_of_birth_ordinal: int) -> 'Record':
+        """Build a Record from an already parsed date of birth ordinal, skipping date parsing."""
+        record = cls.__new__(cls)
+        record.last_name = intern(last_name)
+        record.first_name = intern(first_name)
+        record.email = email
+        record.favorite_color = intern(favorite_color)
+        record._date_of_birth_ordinal = date_of_birth_ordinal
+        record._date_of_birth = _format_date_ordinal(date_of_birth_ordinal)
+        return record
 
     @property
     def date_of_birth(self) -> str:
         """Return date in M/D/YYYY format."""
-        return self._date_of_birth.strftime("%m/%d/%Y")
+        return self._date_of_birth
 
     @date_of_birth.setter
     def date_of_birth(self, date_str: str):
-        self._date_of_birth = parse(date_str)
+        self._date_of_birth_ordinal = parse_date_ordinal(date_str)
+        self._date_of_birth = _format_date_ordinal(self._date_of_birth_ordinal)
+
+    @property
+    def date_of_birth_ordinal(self) -> int:
+        """Return date of birth as a proleptic Gregorian ordinal. Cheapest representation for sorting."""
+        return self._date_of_birth_ordinal
 
     def date_of_birth_as_datetime(self) -> datetime:
         """Return date of birth as a datetime. Useful for sorting."""
-        return self._date_of_birth
+        return datetime.fromordinal(self._date_of_birth_ordinal)
+
+    def as_tuple(self) -> Tuple[str, str, str, str, str]:
+        """Return a representation of a record as a tuple."""
+        return self.last_name, self.first_name, self.email, self.favorite_color, self._date_of_birth
 
     def as_list(self) -> List:
         """Return a representation of a record as a list."""
-        return [self.last_name, self.first_name, self.email, self.favorite_color, self.date_of_birth]
+        return [self.last_name, self.first_name, self.email, self.favorite_color, self._date_of_birth]
 
     def __iter__(self):
         """Make records iterable, order is stable."""
-        return iter(self.as_list())
+        return iter(self.as_tuple())
 
     def __getitem__(self, n: int):
         """Make records subscriptable, order is stable."""
-        return self.as_list()[n]
+        return self.as_tuple()[n]
 
     def __len__(self):
         """Return the number of columns in a record."""
-        return len(self.as_list())
+        return len(RECORD_COLUMNS)
+
+    def __eq__(self, other):
+        """Compare records column by column."""
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self.as_tuple() == other.as_tuple() and self._date_of_birth_ordinal == other._date_of_birth_ordinal
+
+    __hash__ = None
+
+    def __reduce__(self):
+        """Pickle compactly and without re-parsing the date of birth."""
+        return Record.from_ordinal, (self.last_name, self.first_name, self.email, self.favorite_color,
+                                     self._date_of_birth_ordinal)
+
+    def __repr__(self):
+        """Return a developer representation of this record."""
+        return f'Record(last_name={self.last_name!r}, first_name={self.first_name!r}, email={self.email!r}, ' \
+               f'favorite_color={self.favorite_color!r}, date_of_birth={self._date_of_birth!r})'
 
     def __str__(self):
         """Return a string representation of this record."""
@@ -1,129 +1,84 @@
-"""Command line and REST interfaces for the application."""
+"""Command line interface for the application, and the REST interface's app for `uvicorn records:app`.
+
+Only the command line's dependencies are imported up front, the web stack is imported from the api module on first
+access to app or any other of its names.
+"""
 import argparse
-import csv
+import locale
 import logging
 import sys
-from typing import Optional, List
-
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.openapi.utils import get_openapi
-from pydantic.main import BaseModel
-
-from domain.record import read_records, sort_records
-from models.record import RecordFileType, Record
-
-# API ------------------------------------------------------------------------------------------------------------------
-
-
-app = FastAPI()
-
-# Holds records for the duration this API instance's lifetime
-web_records = []
-
-
-class CreateRecordRequestModel(BaseModel):
-    """Pydantic request model for adding a Record."""
-
-    record: str
-    fmt: Optional[str] = "csv"
-
-
-@app.post('/records',
-          status_code=201,
-          response_model=List[str],
-          operation_id="create_record",
-          summary="Create a record",
-          description="Create a record and save in-memory for the lifetime of this API instance. "
-                      "Provide last name, first name, email, color, and date of birth respectively. "
-                      "Separate values using the separator specified in fmt. csv:, psv:|, ssv: .")
-async def add_record(request: CreateRecordRequestModel) -> List[str]:
-    """Handle adding a Record to Record storage."""
-    if request.fmt not in ['csv', 'psv', 'ssv']:
-        raise HTTPException(status_code=422, detail="unsupported record format")
-
-    try:
-        delimiter = RecordFileType.delimiters[RecordFileType(request.fmt)]
-        web_records.append([Record(*row) for row in csv.reader([request.record], delimiter=delimiter)][0])
-    except TypeError:
-        raise HTTPException(status_code=422, detail="record syntax invalid, failed to parse")
-    return web_records[-1].as_list()
-
-
-@app.get('/records',
-         response_model=List[List[str]],
-         operation_id="get_records",
-         summary="Retrieve all records with optional sort",
-         description="Retrieve all records with optional sort. "
-                     "Multiple sorts are supported with the first being highest priority. "
-                     "Sorts are specified with the format [column number],[direction]. "
-                     "Example: 0,DESC to sort last name.")
-async def get_records(sort: List[str] = Query(None)) -> List[List[str]]:
-    """Retrieve all records with given sorting rules."""
+from itertools import islice
+from typing import List, Optional, Tuple
+
+from domain import metrics
+from domain.collation import COLLATIONS
+from domain.external_sort import external_sort_records, memory_size
+from domain.incremental import update_sorted_output
+from domain.record import DEDUPE_MODES, EMAIL_KEY, SORT_ENGINES, dedupe_records, iter_records, parse_key_columns, \
+    read_records, read_top_records, sort_records, write_records
+from models.record import RecordFileType
+
+
+def __getattr__(name: str):
+    """Resolve the API's names, such as app, from the api module, importing the web stack on first access."""
+    if name.startswith('__'):
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    import api
     try:
-        sorted_records = sort_records(web_records, sort)
-    except ValueError:
-        raise HTTPException(status_code=400, detail="sort parameters are invalid")
-    return [r.as_list() for r in sorted_records]
-
-
-@app.get('/records/email',
-         response_model=List[List[str]],
-         operation_id="get_records_email_sort",
-         summary="Retrieve all records with email sort ascending",
-         description="Retrieve all records with email sort ascending.")
-async def get_records_email_sort() -> List[List[str]]:
-    """Retrieve all records with pre-selected email sort."""
-    return await get_records(['2,ASC'])
-
-
-@app.get('/records/birthdate',
-         response_model=List[List[str]],
-         operation_id="get_records_birthdate_sort",
-         summary="Retrieve all records with birthdate sort ascending",
-         description="Retrieve all records with birthdate sort ascending.")
-async def get_records_birthdate_sort() -> List[List[str]]:
-    """Retrieve all records with pre-selected birthdate sort."""
-    return await get_records(['4,ASC'])
-
-
-@app.get('/records/name',
-         response_model=List[List[str]],
-         operation_id="get_records_name_sort",
-         summary="Retrieve all records with name sort ascending",
-         description="Retrieve all records with name sort ascending. Name is computed as '[First] [Last]'")
-async def get_records_name_sort() -> List[List[str]]:
-    """Retrieve all records with pre-selected first + last name sort."""
-    # Sort by the combination of first + last name
-    sorted_records = sorted(web_records, key=lambda record: f'{record[1]} {record[0]}')
-    return [r.as_list() for r in sorted_records]
-
-
-def customize_openapi():
-    """Customize the openapi dashboard and add a title / version."""
-    if app.openapi_schema:
-        return app.openapi_schema
-    openapi_schema = get_openapi(
-        title="Records Demo Application",
-        version="1.0",
-        description="Record Demo Application REST API Documentation",
-        routes=app.routes,
-    )
-    app.openapi_schema = openapi_schema
-    return app.openapi_schema
-
-
-app.openapi = customize_openapi
+        return getattr(api, name)
+    except AttributeError:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
 
 
 # CLI ------------------------------------------------------------------------------------------------------------------
 
 
-def process_records(files: List[str], sort: List[str], fmt: str, output_stream=sys.stdout):
-    """Accept a list of record files and outputs them in the given format, optionally sorting."""
-    records = read_records(files)
-    writer = csv.writer(output_stream, delimiter=RecordFileType.delimiters[RecordFileType(fmt)])
-    sorted_records = sort_records(records, sort)
-    writer.writerows(sorted_records)
+@metrics.timed('records_process_seconds')
+def process_records(files: List[str], sort: List[str], fmt: str, output_stream=sys.stdout,
+                    max_memory: Optional[int] = None, spill_dir: Optional[str] = None, jobs: int = 1,
+                    engine: str = 'auto', limit: Optional[int] = None, collation: str = 'ordinal',
+                    dedupe: Optional[str] = None, key_columns: Tuple[int, ...] = EMAIL_KEY):
+    """Accept a list of record files and outputs them in the given format, optionally sorting.
+
+    Unsorted runs stream records straight from input to output in constant memory. When max_memory is given, records
+    are sorted with an external merge sort that holds roughly max_memory bytes of records at a time and spills sorted
+    runs to temporary files under spill_dir. Otherwise files are parsed in a pool of jobs processes when jobs is
+    greater than one. engine picks the in-memory sort implementation, see domain.record.sort_order, and strings
+    compare in collation, see domain.collation.
+
+    With a limit only the first limit sorted records are output. Unless parsing in several processes or deduping, they
+    are selected while streaming the input, holding about limit records regardless of max_memory.
+
+    With dedupe, records whose key_columns equal an earlier record's are dropped before sorting, keeping the 'first'
+    or the 'last' of them, see domain.record.dedupe_records. Keeping the last holds every record, so it can't be
+    combined with max_memory.
+    """
+    fmt = RecordFileType(fmt)
+    if dedupe == 'last' and max_memory:
+        raise ValueError('Fatal error, keeping the last duplicate can not be combined with max_memory.')
+
+    if not sort and jobs <= 1:
+        records = iter_records(files)
+        if dedupe:
+            records = dedupe_records(records, key_columns, dedupe)
+        write_records(islice(records, limit), fmt, output_stream)
+        return
+
+    if limit is not None and jobs <= 1 and not dedupe:
+        write_records(read_top_records(files, sort, limit, collation), fmt, output_stream)
+        return
+
+    if max_memory:
+        sorted_records = external_sort_records(files, sort, max_memory, spill_dir, engine, collation,
+                                               key_columns if dedupe else None)
+        write_records(islice(sorted_records, limit), fmt, output_stream)
+        return
+
+    records = read_records(files, jobs=jobs)
+    if dedupe:
+        records = list(dedupe_records(records, key_columns, dedupe))
+    sorted_records = sort_records(records, sort, engine, limit, collation)
+    write_records(sorted_records, fmt, output_stream)
 
 
 def cli_entry():
@@ -131,17 +86,66 @@ def cli_entry():
     logging.basicConfig(format='[%(levelname)s] %(asctime)s %(filename)s:%(lineno)d %(message)s')
     parser = argparse.ArgumentParser(description='Accepts an arbitrary number of record files and sorts them')
     parser.add_argument('files', metavar='FILE', nargs='+',
-                        help='Record files to be parsed, supports *.csv, *.psv, and *.ssv')
+                        help='Record files to be parsed, supports *.csv, *.psv, *.ssv, and binary *.rbf')
     parser.add_argument('-s', '--sort', nargs='*', metavar='SORT', type=str,
                         help='Zero-based sort column index and direction. '
                              'Specify column number and direction separated by a comma. '
                              '"ASC" represents ascending, "DESC" represents descending. '
                              'Sort priority reflects the order sorts are provided.')
     parser.add_argument('-f', '--format', metavar='FORMAT', default="csv",
-                        choices=['csv', 'psv', 'ssv'],
-                        help='Format to output records in, accepts csv, psv, and ssv')
+                        choices=['csv', 'psv', 'ssv', 'rbf'],
+                        help='Format to output records in, accepts csv, psv, ssv, and binary rbf')
+    parser.add_argument('--max-memory', metavar='SIZE', type=memory_size,
+                        help='Sort inputs larger than memory by spilling sorted runs to disk, '
+                             'holding roughly SIZE bytes of records at a time. Accepts sizes like 512M or 2G.')
+    parser.add_argument('--spill-dir', metavar='DIR',
+                        help='Directory for temporary sorted runs when --max-memory is used, '
+                             'defaults to the system temporary directory')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='Parse input files in N processes, large files are split on line boundaries')
+    parser.add_argument('--engine', default='auto', choices=SORT_ENGINES,
+                        help='Sort implementation, "numpy" sorts columns with NumPy when it is installed and "auto" '
+                             'does so for large inputs')
+    parser.add_argument('--collation', default='ordinal', choices=COLLATIONS,
+                        help='String order, "ordinal" compares code points so uppercase sorts first, "casefold" '
+                             'ignores case and "locale" follows the LC_COLLATE locale')
+    parser.add_argument('--limit', metavar='N', type=int,
+                        help='Only output the first N records, selected without sorting or holding the whole input')
+    parser.add_argument('--dedupe', choices=DEDUPE_MODES,
+                        help='Drop records sharing a --key with another, keeping the first one read, or the last one '
+                             'in place of the first')
+    parser.add_argument('--key', metavar='COLUMNS', type=parse_key_columns, default=EMAIL_KEY,
+                        help='Zero-based column numbers identifying a record for --dedupe, separated by commas. '
+                             'Defaults to 2, the email')
+    parser.add_argument('--incremental', metavar='OUTPUT',
+                        help='Maintain OUTPUT as the sorted records of every input so far instead of writing to '
+                             'stdout. Only inputs not yet merged into it are read and sorted, then merged with it, '
+                             'going by a manifest next to it')
+    parser.add_argument('--profile', action='store_true',
+                        help='Time reading, parsing and sorting, and print the measurements to stderr when done')
     args = parser.parse_args()
-    process_records(args.files, args.sort, args.format)
+    if args.limit is not None and args.limit < 0:
+        parser.error('--limit must not be negative')
+    if args.incremental and (args.limit is not None or args.dedupe):
+        parser.error('--limit and --dedupe can not be used with --incremental')
+    if args.dedupe == 'last' and args.max_memory:
+        parser.error('--dedupe last can not be used with --max-memory, it holds every record')
+    if args.profile:
+        metrics.enable()
+    if args.collation == 'locale':
+        locale.setlocale(locale.LC_COLLATE, '')
+    try:
+        if args.incremental:
+            update_sorted_output(args.files, args.sort, args.format, args.incremental, jobs=args.jobs,
+                                 engine=args.engine, collation=args.collation, max_memory=args.max_memory,
+                                 spill_dir=args.spill_dir)
+        else:
+            process_records(args.files, args.sort, args.format, max_memory=args.max_memory,
+                            spill_dir=args.spill_dir, jobs=args.jobs, engine=args.engine, limit=args.limit,
+                            collation=args.collation, dedupe=args.dedupe, key_columns=args.key)
+    finally:
+        if args.profile:
+            print(metrics.summary(), file=sys.stderr)
 
 
 if __name__ == '__main__':
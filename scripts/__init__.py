@@ -0,0 +1 @@
+"""Utility scripts module."""
@@ -1,46 +1,159 @@
-"""Generates example test inputs in '<project_root>/sample_inputs/'."""
+"""Generates example test inputs in '<project_root>/sample_inputs/', or large seeded fixtures in any directory.
+
+With --output-dir, rows are drawn from vocabulary pools sampled once from Faker and streamed straight to sharded files,
+written in parallel when --jobs is more than one. Rows are generated in fixed blocks, each from its own random stream
+seeded by the seed and the block number, so a seed always generates the same rows however they are split into shards.
+"""
 import argparse
-import csv
+import random
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
 from pathlib import Path
-from typing import List
+from typing import Iterable, Iterator, List, NamedTuple, Optional
 
 from faker import Faker
 
+from domain.record import write_records
 from models.record import Record, RecordFileType
 
 OUTPUT_PATH = Path(__file__).parent.parent / 'sample_inputs'
 MIN_SAMPLE_LENGTH = 1
-MAX_SAMPLE_LENGTH = 1000
 
+# Rows generated from each random stream of the pooled generator
+BLOCK_SIZE = 65536
+# Values sampled from Faker per vocabulary pool, Faker's own weighting carries over as repeated values
+POOL_SIZE = 4096
+# Pooled birth dates are fixed dates rather than ages, so output doesn't depend on the day it's generated
+MIN_BIRTH_ORDINAL = date(1910, 1, 1).toordinal()
+MAX_BIRTH_ORDINAL = date(2020, 12, 31).toordinal()
+
+
+def sample_records(n: int, seed: Optional[int] = None) -> Iterator[Record]:
+    """Lazily generate n fake records, the same records every time for the same seed."""
+    fake = Faker()
+    if seed is not None:
+        fake.seed_instance(seed)
+    for _ in range(n):
+        yield Record(
+            fake.last_name(),
+            fake.first_name(),
+            fake.email(),
+            fake.color_name(),
+            fake.date_of_birth().strftime("%m/%d/%Y"))
+
+
+class VocabularyPools(NamedTuple):
+    """Values pooled records are drawn from."""
+
+    last_names: List[str]
+    first_names: List[str]
+    colors: List[str]
+    email_domains: List[str]
+
+
+def vocabulary_pools(seed: int, size: int = POOL_SIZE) -> VocabularyPools:
+    """Sample vocabulary pools from Faker, the same pools every time for the same seed."""
+    fake = Faker()
+    fake.seed_instance(seed)
+    return VocabularyPools([fake.last_name() for _ in range(size)],
+                           [fake.first_name() for _ in range(size)],
+                           [fake.color_name() for _ in range(size)],
+                           [fake.free_email_domain() for _ in range(size)])
+
+
+def _email_local_part(name: str) -> str:
+    """Return a name as it would appear in an email address."""
+    return ''.join(c for c in name.lower() if c.isalnum())
+
+
+def pooled_records(start: int, stop: int, seed: int, pools: VocabularyPools) -> Iterator[Record]:
+    """Lazily generate rows start up to stop of the dataset for seed, drawing values from pools.
 
-def write_example_input(records: List[Record], fmt: RecordFileType):
-    """Given list of records and an output format, writes example file to the 'sample_inputs' directory."""
-    with (OUTPUT_PATH / f"example.{fmt.value}").open('w', newline='') as out_stream:
-        writer = csv.writer(out_stream, delimiter=RecordFileType.delimiters[fmt])
-        writer.writerows(records)
+    Emails hold the row number, so they are unique across the whole dataset.
+    """
+    last_locals = list(map(_email_local_part, pools.last_names))
+    first_locals = list(map(_email_local_part, pools.first_names))
+    for block in range(start // BLOCK_SIZE, (stop + BLOCK_SIZE - 1) // BLOCK_SIZE):
+        rng = random.Random(f'{seed}:{block}')
+        block_start = block * BLOCK_SIZE
+        lasts = rng.choices(range(len(pools.last_names)), k=BLOCK_SIZE)
+        firsts = rng.choices(range(len(pools.first_names)), k=BLOCK_SIZE)
+        colors = rng.choices(pools.colors, k=BLOCK_SIZE)
+        domains = rng.choices(pools.email_domains, k=BLOCK_SIZE)
+        births = rng.choices(range(MIN_BIRTH_ORDINAL, MAX_BIRTH_ORDINAL + 1), k=BLOCK_SIZE)
+
+        for i in range(max(start, block_start) - block_start, min(stop, block_start + BLOCK_SIZE) - block_start):
+            last, first = lasts[i], firsts[i]
+            yield Record.from_ordinal(pools.last_names[last], pools.first_names[first],
+                                      f'{first_locals[first]}.{last_locals[last]}{block_start + i}@{domains[i]}',
+                                      colors[i], births[i])
+
+
+def write_sample_file(records: Iterable[Record], fmt: RecordFileType, path: Path):
+    """Write records to path in the given format."""
+    with (path.open('wb') if fmt is RecordFileType.BINARY else path.open('w', newline='')) as out_stream:
+        write_records(records, fmt, out_stream)
+
+
+def _write_pooled_shard(path: Path, fmt: RecordFileType, start: int, stop: int, seed: int,
+                        pools: VocabularyPools) -> Path:
+    """Write rows start up to stop of the dataset for seed to path."""
+    write_sample_file(pooled_records(start, stop, seed, pools), fmt, path)
+    return path
+
+
+def generate_sample_files(n: int, seed: int, fmt: RecordFileType, output_dir: Path, shards: int = 1, jobs: int = 1,
+                          prefix: str = 'records') -> List[Path]:
+    """Write n pooled records for seed to shards files in output_dir, in a pool of jobs processes.
+
+    A single shard is written to <prefix>.<ext>, several to <prefix>-<shard number>.<ext>, each holding an equal run of
+    consecutive rows.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    pools = vocabulary_pools(seed)
+    bounds = [n * shard // shards for shard in range(shards + 1)]
+    paths = [output_dir / f'{prefix}.{fmt.value}'] if shards == 1 else \
+        [output_dir / f'{prefix}-{shard:05d}.{fmt.value}' for shard in range(shards)]
+    tasks = [(path, fmt, start, stop, seed, pools) for path, start, stop in zip(paths, bounds, bounds[1:])]
+
+    if jobs <= 1:
+        return [_write_pooled_shard(*task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(_write_pooled_shard, *zip(*tasks)))
+
+
+def write_example_input(records: Iterable[Record], fmt: RecordFileType):
+    """Given records and an output format, writes example file to the 'sample_inputs' directory."""
+    write_sample_file(records, fmt, OUTPUT_PATH / f"example.{fmt.value}")
 
 
 def main():
     """Command line entrypoint for this utility script."""
     parser = argparse.ArgumentParser(description='Generate example test inputs in <project_root>/sample_inputs/')
     parser.add_argument('-n', type=int, default=100,
-                        help=f'Number of records to generate in test files, {MIN_SAMPLE_LENGTH}-{MAX_SAMPLE_LENGTH}')
+                        help=f'Number of records to generate in test files, at least {MIN_SAMPLE_LENGTH}')
+    parser.add_argument('--seed', type=int, help='Seed to generate the same records on every run')
+    parser.add_argument('--output-dir', type=Path,
+                        help='Stream pooled records to files in this directory instead of writing example inputs')
+    parser.add_argument('-f', '--format', default='csv', choices=[fmt.value for fmt in RecordFileType],
+                        help='Format of files written to --output-dir')
+    parser.add_argument('--shards', type=int, help='Number of files written to --output-dir, defaults to --jobs')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Write shards in N processes')
     args = parser.parse_args()
 
-    if args.n < MIN_SAMPLE_LENGTH or args.n > MAX_SAMPLE_LENGTH:
+    if args.n < MIN_SAMPLE_LENGTH:
         parser.print_help()
         return
 
-    fake = Faker()
-    records = [Record(
-        fake.last_name(),
-        fake.first_name(),
-        fake.email(),
-        fake.color_name(),
-        fake.date_of_birth().strftime("%m/%d/%Y")) for _ in range(args.n)]
+    # Each file regenerates the same records from the seed rather than holding them all in memory
+    seed = random.randrange(2 ** 32) if args.seed is None else args.seed
+    if args.output_dir:
+        generate_sample_files(args.n, seed, RecordFileType(args.format), args.output_dir,
+                              max(1, args.shards or args.jobs), args.jobs)
+        return
 
     for file_type in RecordFileType:
-        write_example_input(records, file_type)
+        write_example_input(sample_records(args.n, seed), file_type)
 
 
 if __name__ == '__main__':
@@ -1,13 +1,24 @@
 """API Tests."""
+import asyncio
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import List
 
 import pytest
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
 
+import api
+import domain.store
 import records
+from domain import metrics
+from domain.storage import MemoryBackend, MmapBackend
+from domain.store import RecordStore
+from models.record import Record
 
-client = TestClient(records.app)
+client = TestClient(api.app)
 
 
 # Utility --------------------------------------------------------------------------------------------------------------
@@ -15,11 +26,17 @@ client = TestClient(records.app)
 @pytest.fixture(autouse=True)
 def run_before_and_after_tests(tmpdir):
     """Fixture for setup and teardown."""
-    records.app = FastAPI()
-    records.web_records = []
+    api.app = FastAPI()
+    api.web_records = RecordStore()
     yield
 
 
+def bulk_lines(n: int, colors: List[str]) -> List[str]:
+    """Build n pipe separated record lines with unique emails, repeating names, colors and birth dates."""
+    return [f'last{i % 7}|first{i % 3}|{i}@b.c|{colors[i % len(colors)]}|{i % 12 + 1}-3-19{50 + i % 40}'
+            for i in range(n)]
+
+
 # Tests ----------------------------------------------------------------------------------------------------------------
 
 def test_read_records_empty():
@@ -179,3 +196,418 @@ def test_add_record_fuzz():
     for s in blns:
         response = client.post('/records', data=s)
         assert response.status_code == 422
+
+
+def test_read_records_sort_after_add():
+    """Sorted reads see records added after the sort was first requested, ties stay in insertion order."""
+    client.post('/records', json={'record': 'b,first,b@b.c,pumice,3-3-2222', 'fmt': 'csv'})
+    client.post('/records', json={'record': 'a,first,a@b.c,pumice,3-3-3333', 'fmt': 'csv'})
+    assert [r[0] for r in client.get('/records', params={'sort': ['3,ASC', '0,DESC']}).json()] == ['b', 'a']
+
+    client.post('/records', json={'record': 'c,first,a@b.c,pumice,3-3-1111', 'fmt': 'csv'})
+    client.post('/records', json={'record': 'b,second,c@b.c,pumice,3-3-1111', 'fmt': 'csv'})
+    assert [r[:2] for r in client.get('/records', params={'sort': ['3,ASC', '0,DESC']}).json()] == \
+        [['c', 'first'], ['b', 'first'], ['b', 'second'], ['a', 'first']]
+    assert [r[2] for r in client.get('/records/email').json()] == ['a@b.c', 'a@b.c', 'b@b.c', 'c@b.c']
+    assert [r[4] for r in client.get('/records/birthdate').json()] == \
+        ['03/03/1111', '03/03/1111', '03/03/2222', '03/03/3333']
+    assert [r[:2] for r in client.get('/records/name').json()] == \
+        [['a', 'first'], ['b', 'first'], ['c', 'first'], ['b', 'second']]
+
+
+def test_read_records_page():
+    """Sorted reads page with offset and limit and report the total record count."""
+    for last in ['d', 'b', 'a', 'c']:
+        client.post('/records', json={'record': f'{last},first,email,pumice,3-3-3333', 'fmt': 'csv'})
+
+    response = client.get('/records', params={'sort': '0,ASC', 'offset': 1, 'limit': 2})
+    assert response.status_code == 200
+    assert response.headers['X-Total-Count'] == '4'
+    assert [r[0] for r in response.json()] == ['b', 'c']
+    assert [r[0] for r in client.get('/records', params={'offset': 3}).json()] == ['c']
+    assert [r[0] for r in client.get('/records/name', params={'limit': 1}).json()] == ['a']
+    assert client.get('/records/email', params={'offset': 10}).json() == []
+    assert client.get('/records', params={'limit': -1}).status_code == 422
+
+
+def test_read_records_stream():
+    """Streamed reads return one JSON record array per line."""
+    for last in ['d', 'b', 'a', 'c']:
+        client.post('/records', json={'record': f'{last},first,email,pumice,3-3-3333', 'fmt': 'csv'})
+
+    response = client.get('/records/birthdate', params={'stream': True, 'limit': 3})
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    assert [json.loads(line) for line in response.text.splitlines()] == \
+        [[last, 'first', 'email', 'pumice', '03/03/3333'] for last in ['d', 'b', 'a']]
+
+
+def test_read_records_stream_reads_lazily(monkeypatch):
+    """Streamed pages read their records from the store a batch at a time as they're sent."""
+    client.post('/records/bulk', params={'fmt': 'psv'}, content='\n'.join(bulk_lines(25, ['pumice'])).encode('utf-8'))
+    monkeypatch.setattr(api, 'STREAM_BATCH_SIZE', 10)
+    api.web_records.sorted_by_name()
+    reads = []
+
+    class CountedBackend(MemoryBackend):
+        def __getitem__(self, i):
+            reads.append(i)
+            return super().__getitem__(i)
+
+    monkeypatch.setattr(api.web_records, '_records', CountedBackend(api.web_records._records))
+    page, total = api.web_records.sorted_by_name()
+    assert reads == []
+    lines = api._ndjson_lines(page)
+    assert next(lines).count('\n') == 10 and len(reads) == 10
+    assert sum(chunk.count('\n') for chunk in lines) == 15 and len(reads) == 25
+
+    response = client.get('/records/name', params={'stream': True})
+    assert len(response.text.splitlines()) == 25
+
+
+def test_add_records_bulk():
+    """Bulk uploads store every valid line at once and report the others by line number."""
+    client.post('/records', json={'record': 'zed,first,z@b.c,pumice,3-3-3333', 'fmt': 'csv'})
+    client.get('/records', params={'sort': ['1,DESC', '0,ASC']})
+    lines = bulk_lines(200, ['pumice'])
+    lines[10] = 'too|few|columns'
+    lines[20] = 'bad|date|x@b.c|pumice|not a date'
+    body = '\r\n'.join(lines).encode('utf-8')
+
+    response = client.post('/records/bulk', params={'fmt': 'psv'}, content=body)
+    assert response.status_code == 201
+    assert response.json()['inserted'] == 198
+    assert response.json()['failed'] == 2
+    assert [error['line'] for error in response.json()['errors']] == [11, 21]
+
+    stored = [line.split('|') for i, line in enumerate(lines) if i not in (10, 20)]
+    response = client.get('/records', params={'sort': ['1,DESC', '0,ASC']})
+    expected = sorted([['zed', 'first', 'z@b.c']] + [r[:3] for r in stored], key=lambda r: r[0])
+    expected.sort(key=lambda r: r[1], reverse=True)
+    assert [r[:3] for r in response.json()] == expected
+    assert [r[2] for r in client.get('/records/email').json()] == sorted(r[2] for r in expected)
+
+
+def test_add_records_bulk_bad_input():
+    """Bulk uploads reject unknown formats and bodies that aren't utf-8, storing nothing."""
+    assert client.post('/records/bulk', params={'fmt': 'xml'}, content=b'a,b,c,d,1-1-1900').status_code == 422
+    assert client.post('/records/bulk', content=b'a,b,c,d,1-1-1900\n\xff\xfe').status_code == 422
+    assert client.get('/records').json() == []
+
+
+def test_add_records_bad_dates():
+    """Dates that fail to parse or overflow are rejected per record, the rest of a bulk upload is still stored."""
+    for date_of_birth in ('not a date', '99999999999999999999'):
+        assert client.post('/records', json={'record': f'a,b,c,d,{date_of_birth}'}).status_code == 422
+    response = client.post('/records/bulk', content=b'a,b,c,d,1-1-2000\na,b,c,d,99999999999999999999\na,b,c,d,x')
+    assert response.status_code == 201
+    assert response.json()['inserted'] == 1
+    assert response.json()['errors'] == [{'line': line, 'detail': 'date of birth invalid, failed to parse'}
+                                         for line in (2, 3)]
+    assert client.get('/records').json() == [['a', 'b', 'c', 'd', '01/01/2000']]
+
+
+def test_read_records_sort_cache():
+    """Repeated sorts hit the cache, writes patch cached orderings, and the least recently used sort is evicted."""
+    api.web_records = RecordStore(sort_cache_size=2)
+    client.post('/records', json={'record': 'b,first,b@b.c,pumice,3-3-2222', 'fmt': 'csv'})
+    client.post('/records', json={'record': 'a,first,a@b.c,pumice,3-3-3333', 'fmt': 'csv'})
+
+    assert [r[0] for r in client.get('/records', params={'sort': '0,ASC'}).json()] == ['a', 'b']
+    assert [r[0] for r in client.get('/records', params={'sort': '0,asc'}).json()] == ['a', 'b']
+    client.post('/records', json={'record': 'c,first,c@b.c,pumice,3-3-1111', 'fmt': 'csv'})
+    assert [r[0] for r in client.get('/records', params={'sort': '0,ASC'}).json()] == ['a', 'b', 'c']
+    client.get('/records', params={'sort': '0,DESC'})
+    client.get('/records', params={'sort': '4,DESC'})
+    client.get('/records', params={'sort': '2,ASC'})
+    assert api.web_records.sort_cache.stats() == {'hits': 2, 'misses': 3, 'patches': 1, 'evictions': 1, 'size': 2}
+    # Repeating a column can't change the order, so it's the same cached ordering
+    client.get('/records', params={'sort': ['4,DESC', '4,ASC', '4,DESC']})
+    assert api.web_records.sort_cache.stats()['hits'] == 3
+
+
+def test_persistent_store(tmpdir):
+    """Records in a memory-mapped store survive a restart and are shared by every store over the same files."""
+    api.web_records = RecordStore(MmapBackend(tmpdir))
+    client.post('/records', json={'record': 'b,first,b@b.c,pumice,3-3-2222', 'fmt': 'csv'})
+    client.post('/records/bulk', params={'fmt': 'csv'},
+                content='\n'.join(f'a{i},ü{i},{i}@b.c,tan,{i % 12 + 1}-1-2000' for i in range(100)).encode('utf-8'))
+    expected = client.get('/records', params={'sort': ['3,DESC', '1,ASC']}).json()
+    assert len(expected) == 101
+
+    other_worker = RecordStore(MmapBackend(tmpdir))
+    api.web_records = RecordStore(MmapBackend(tmpdir))
+    assert client.get('/records', params={'sort': ['3,DESC', '1,ASC']}).json() == expected
+
+    other_worker.add(Record('c', 'first', 'a@b.c', 'pumice', '3-3-1111'))
+    assert client.get('/records/email').json()[-2:] == [['c', 'first', 'a@b.c', 'pumice', '03/03/1111'],
+                                                        ['b', 'first', 'b@b.c', 'pumice', '03/03/2222']]
+    assert client.get('/records', params={'offset': 101}).json() == [['c', 'first', 'a@b.c', 'pumice', '03/03/1111']]
+
+
+def test_persistent_store_warm_start(tmpdir, monkeypatch):
+    """A store reopened over persisted indexes maps them, decoding only the records its reads and new records need."""
+    api.web_records = RecordStore(MmapBackend(tmpdir))
+    client.post('/records/bulk', params={'fmt': 'psv'},
+                content='\n'.join(bulk_lines(300, ['Tan', 'Aqua', 'Red'])).encode('utf-8'))
+    paths = [('/records/name', {}), ('/records/email', {}), ('/records/birthdate', {}),
+             ('/records', {'filter': '3,eq,Tan'})]
+    expected = [client.get(path, params=params).json() for path, params in paths]
+    with TestClient(client.app):
+        pass
+    assert sorted(path.name for path in Path(tmpdir).glob('*.idx')) == \
+        ['name.ordinal.idx', 'sort-2a.ordinal.idx', 'sort-3a.ordinal.idx', 'sort-4a.ordinal.idx']
+
+    decoded = []
+    decode = MmapBackend._record
+    monkeypatch.setattr(MmapBackend, '_record',
+                        staticmethod(lambda mapping, i: decoded.append(i) or decode(mapping, i)))
+    api.web_records = RecordStore(MmapBackend(tmpdir))
+    assert client.get('/records/name', params={'limit': 5}).json() == expected[0][:5]
+    assert len(decoded) == 5
+    decoded.clear()
+    assert [client.get(path, params=params).json() for path, params in paths] == expected
+    # Besides the records read, filtering only decodes the keys it bisects the column's index by
+    assert 3 * 300 + 100 < len(decoded) < 3 * 300 + 100 + 2 * 10
+
+    other_worker = RecordStore(MmapBackend(tmpdir))
+    other_worker.add(Record('a', 'a', 'a', 'Tan', '1-1-2000'))
+    decoded.clear()
+    assert client.get('/records/name', params={'limit': 1}).json() == [['a', 'a', 'a', 'Tan', '01/01/2000']]
+    # The new record, and the keys it bisects each of the four indexes by
+    assert len(decoded) < 1 + 4 * 10
+
+
+def test_persistent_store_persists_as_indexes_grow(tmpdir, monkeypatch):
+    """Kept indexes are persisted as they grow by a share of their records, and only over the records they cover."""
+    monkeypatch.setattr(domain.store, 'INDEX_PERSIST_MIN_RECORDS', 10)
+    store = RecordStore(MmapBackend(tmpdir))
+    store.extend([Record(f'n{i}', 'first', f'{i}@b.c', 'Tan', '1-1-2000') for i in range(5)])
+    store.sorted_by_name()
+    assert not (Path(tmpdir) / 'name.ordinal.idx').exists()
+    store.extend([Record(f'n{i}', 'first', f'{i}@b.c', 'Tan', '1-1-2000') for i in range(5, 100)])
+    assert (Path(tmpdir) / 'name.ordinal.idx').stat().st_size == 100 * 8
+
+    # A persisted index covering records this store doesn't have is rebuilt from the records it does
+    store = RecordStore(MmapBackend(Path(tmpdir)))
+    (Path(tmpdir) / 'date_of_birth.i32').write_bytes((Path(tmpdir) / 'date_of_birth.i32').read_bytes()[:50 * 4])
+    assert [r.last_name for r in store.sorted_by_name()[0]] == sorted(f'n{i}' for i in range(50))
+
+
+@pytest.mark.parametrize('persistent', [False, True])
+def test_concurrent_store(tmpdir, persistent):
+    """Reads from many threads see consistent, sorted snapshots while other threads write."""
+    store = RecordStore(MmapBackend(tmpdir) if persistent else None, sort_cache_size=2)
+    batches = [[Record(f'last{(b + i) % 13}', 'first', f'{b}.{i}@b.c', ['Tan', 'Aqua'][i % 2], f'{i % 12 + 1}-1-2000')
+                for i in range(50)] for b in range(20)]
+
+    def read(sorts, key):
+        page, count = store.sorted(sorts)
+        assert len(page) <= count
+        assert [key(r) for r in page] == sorted(key(r) for r in page)
+        matches, total = store.filtered(['3,eq,Tan'], ['0,ASC'])
+        assert len(matches) == total and all(r.favorite_color == 'Tan' for r in matches)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        writes = [pool.submit(store.extend, batch) for batch in batches]
+        reads = [pool.submit(read, ['3,ASC', '0,ASC'], lambda r: (r.favorite_color, r.last_name)) for _ in range(10)]
+        reads += [pool.submit(read, ['0,ASC'], lambda r: r.last_name) for _ in range(10)]
+        for future in writes + reads:
+            future.result()
+
+    assert len(store) == 1000
+    assert len({r.email for r in store.sorted(['0,ASC', '2,DESC'])[0]}) == 1000
+    assert store.filtered(['3,eq,Tan'])[1] == 500
+
+
+def test_collated_store():
+    """A case-insensitive store sorts every endpoint ignoring case, while filters still match exact strings."""
+    api.web_records = RecordStore(collation='casefold')
+    client.post('/records/bulk', params={'fmt': 'csv'},
+                content=b'beta,Al,B@b.c,tan,1-1-2000\nAlpha,al,a@b.c,Tan,1-1-2001\nalpha,Bo,c@b.c,tan,1-1-2002')
+
+    assert [r[0] for r in client.get('/records', params={'sort': ['0,ASC', '4,DESC']}).json()] == \
+        ['alpha', 'Alpha', 'beta']
+    assert [r[2] for r in client.get('/records/email').json()] == ['a@b.c', 'B@b.c', 'c@b.c']
+    assert [r[1] for r in client.get('/records/name').json()] == ['al', 'Al', 'Bo']
+    response = client.get('/records', params={'filter': '3,eq,tan', 'sort': '0,DESC'})
+    assert [r[0] for r in response.json()] == ['beta', 'alpha']
+
+
+def test_upsert():
+    """Upserts replace records by key in place, keeping fixed, cached and filter indexes consistent with a rebuild."""
+    api.web_records = RecordStore(key_columns=(2,))
+    lines = bulk_lines(200, ['Tan', 'Aqua', 'Red'])
+    client.post('/records/bulk', params={'fmt': 'psv'}, content='\n'.join(lines).encode('utf-8'))
+    sorts = [['0,ASC'], ['3,DESC', '4,ASC'], ['1,DESC', '2,ASC']]
+    for sort in sorts:
+        client.get('/records', params={'sort': sort})
+    client.get('/records', params={'filter': '3,eq,Tan'})
+
+    assert client.post('/records', params={'upsert': True},
+                       json={'record': 'new,n,7@b.c,Tan,1-1-2000', 'fmt': 'csv'}).status_code == 200
+    assert client.post('/records', params={'upsert': True},
+                       json={'record': 'new,n,new@b.c,Tan,1-1-2000', 'fmt': 'csv'}).status_code == 201
+    rng = random.Random(0)
+    upserts = [f'z{rng.randrange(9)}|first{rng.randrange(3)}|{rng.randrange(250)}@b.c|{rng.choice(["Tan", "Red"])}|'
+               f'{rng.randrange(12) + 1}-3-1960' for _ in range(100)]
+    response = client.post('/records/bulk', params={'fmt': 'psv', 'upsert': True}, content='\n'.join(upserts).encode())
+    keys = [line.split('|')[2] for line in upserts]
+    new_keys = set(keys) - {f'{i}@b.c' for i in range(200)}
+    assert response.json()['inserted'] == len(new_keys)
+    assert response.json()['replaced'] == len(set(keys) - new_keys)
+
+    stored = list(api.web_records)
+    assert len(stored) == 201 + len(new_keys)
+    assert len({r.email for r in stored}) == len(stored)
+    rebuilt = RecordStore()
+    rebuilt.extend(stored)
+    for sort in sorts + [['2,ASC'], ['4,ASC']]:
+        assert api.web_records.sorted(sort) == rebuilt.sorted(sort), sort
+    assert api.web_records.sorted_by_name() == rebuilt.sorted_by_name()
+    assert api.web_records.filtered(['3,eq,Tan']) == rebuilt.filtered(['3,eq,Tan'])
+
+
+def test_upsert_repeated_key():
+    """A key repeated within one batch counts once, whether it inserts or replaces, and its last record is kept."""
+    store = RecordStore(key_columns=(2,))
+    store.add(Record('old', 'f', 'a@b.c', 'Tan', '1-1-2000'))
+    batch = [Record(last_name, 'f', email, 'Tan', '1-1-2000')
+             for last_name, email in [('a1', 'a@b.c'), ('n1', 'n@b.c'), ('a2', 'a@b.c'), ('n2', 'n@b.c')]]
+    assert store.upsert_many(batch) == (1, 1)
+    assert [r.last_name for r in store] == ['a2', 'n2']
+
+
+def test_upsert_while_indexing(monkeypatch):
+    """Records replaced while a sort or filter index is built from a snapshot are not lost from it."""
+    store = RecordStore(key_columns=(2,))
+    store.extend([Record(f'n{i}', 'first', f'{i}@b.c', 'Tan', '1-1-2000') for i in range(3)])
+    build_sort_index, build_column_index = domain.store._sorted_index, domain.store.SortedIndex
+
+    def upsert_while_building(build, record):
+        """Wrap an index builder to upsert record after building outside of the store's lock."""
+        def build_and_upsert(*args, **kwargs):
+            index = build(*args, **kwargs)
+            if not store._lock._is_owned():
+                store.upsert(record)
+            return index
+        return build_and_upsert
+
+    zz, a = Record('zz', 'f', '0@b.c', 'Tan', '1-1-2000'), Record('a', 'f', '1@b.c', 'Red', '1-1-2000')
+    monkeypatch.setattr('domain.store._sorted_index', upsert_while_building(build_sort_index, zz))
+    store.sorted(['0,ASC'])
+    monkeypatch.setattr('domain.store.SortedIndex', upsert_while_building(build_column_index, a))
+    store.filtered(['3,eq,Tan'])
+    monkeypatch.undo()
+    store.upsert(Record('yy', 'f', '0@b.c', 'Aqua', '1-1-2000'))
+
+    assert [r.last_name for r in store.sorted(['0,ASC'])[0]] == ['a', 'n2', 'yy']
+    assert [r.last_name for r in store.filtered(['3,eq,Tan'])[0]] == ['n2']
+    assert [r.last_name for r in store.filtered(['3,eq,Aqua'])[0]] == ['yy']
+
+
+def test_upsert_without_key():
+    """Upserting into a store without key columns is rejected, and nothing is stored."""
+    response = client.post('/records', params={'upsert': True}, json={'record': 'a,b,c,d,1-1-2000', 'fmt': 'csv'})
+    assert response.status_code == 400
+    assert client.get('/records').json() == []
+
+
+def test_read_records_filter():
+    """Filters select records before sorting and paging, and the total count covers only the matches."""
+    lines = bulk_lines(300, ['Tan', 'Tangerine', 'Aqua'])
+    client.post('/records/bulk', params={'fmt': 'psv'}, content='\n'.join(lines).encode('utf-8'))
+    stored = client.get('/records').json()
+    born = {r[2]: int(r[2].split('@')[0]) for r in stored}
+
+    response = client.get('/records', params={'filter': ['3,eq,Tan', '4,lt,1/1/1970'], 'sort': '2,DESC',
+                                              'limit': 5})
+    assert response.status_code == 200
+    matches = [r for r in stored if r[3] == 'Tan' and 50 + born[r[2]] % 40 < 70]
+    assert response.headers['X-Total-Count'] == str(len(matches))
+    assert response.json() == sorted(matches, key=lambda r: r[2], reverse=True)[:5]
+
+    assert client.get('/records', params={'filter': '3,prefix,Tan'}).json() == [r for r in stored if r[3] != 'Aqua']
+    assert client.get('/records', params={'filter': ['0,ge,last5', '0,le,last6']}).json() == \
+        [r for r in stored if r[0] in ('last5', 'last6')]
+    assert client.get('/records', params={'filter': '2,eq,7@b.c', 'offset': 1}).headers['X-Total-Count'] == '1'
+    assert client.get('/records', params={'filter': '1,gt,first2'}).json() == []
+    assert client.get('/records', params={'filter': '4,ge,12/3/1989'}).json() == \
+        [r for r in stored if r[4] == '12/03/1989']
+
+
+@pytest.mark.parametrize('spec', ['3,Tan', '3,like,Tan', '5,eq,x', '4,prefix,1', '4,eq,not a date', 'x,eq,Tan'])
+def test_read_records_filter_invalid(spec):
+    """Malformed filters are rejected."""
+    assert client.get('/records', params={'filter': spec}).status_code == 400
+
+
+def test_read_records_top_k():
+    """A small page of an uncached sort is selected without caching it, a second read caches the ordering."""
+    lines = bulk_lines(300, ['Tan', 'Aqua', 'Red'])
+    client.post('/records/bulk', params={'fmt': 'psv'}, content='\n'.join(lines).encode('utf-8'))
+    params = {'sort': ['3,DESC', '4,ASC'], 'offset': 2, 'limit': 5}
+    expected = client.get('/records', params={'sort': ['3,DESC', '4,ASC']}).json()[2:7]
+    api.web_records = RecordStore(api.web_records._records)
+
+    assert client.get('/records', params=params).json() == expected
+    assert api.web_records.sort_cache.stats()['size'] == 0
+    assert client.get('/records', params=params).json() == expected
+    assert api.web_records.sort_cache.stats()['misses'] == 1
+
+
+def test_store_stays_off_event_loop(monkeypatch):
+    """Reads and metrics scrapes sync the store, taking its lock, in the threadpool rather than on the event loop."""
+    def sync_off_loop(store):
+        with pytest.raises(RuntimeError):
+            asyncio.get_running_loop()
+        return sync(store)
+
+    sync = RecordStore._sync
+    monkeypatch.setattr(RecordStore, '_sync', sync_off_loop)
+    client.post('/records', json={'record': 'a,first,a@b.c,pumice,3-3-3333', 'fmt': 'csv'})
+    for path in ('/records', '/records/email', '/records/name', '/metrics'):
+        assert client.get(path).status_code == 200, path
+    assert client.get('/records', params={'filter': '0,eq,a'}).headers['X-Total-Count'] == '1'
+    assert client.get('/records', params={'stream': True}).headers['X-Total-Count'] == '1'
+
+
+def test_metrics():
+    """Metrics cover requests by route, parsing, parse errors and sorts when enabled, and nothing else otherwise."""
+    client.post('/records', json={'record': 'a,first,a@b.c,pumice,3-3-3333', 'fmt': 'csv'})
+    assert 'records_http_request_duration_seconds_count' not in client.get('/metrics').text
+
+    metrics.enable()
+    try:
+        client.post('/records', json={'record': 'b,first,b@b.c,pumice,3-3-2222', 'fmt': 'csv'})
+        client.post('/records', json={'record': 'too,few', 'fmt': 'csv'})
+        client.post('/records/bulk', params={'fmt': 'psv'}, content=b'c|first|c@b.c|tan|1-1-1900\nbad')
+        client.get('/records', params={'sort': ['3,DESC', '4,ASC']})
+        # Labels stay bounded whatever clients send
+        for repeats in range(1, 20):
+            client.get('/records', params={'sort': ['3,DESC', '4,ASC'] * repeats, 'limit': 1})
+        client.request('BREW', '/records')
+        text = client.get('/metrics').text
+    finally:
+        metrics.reset()
+
+    assert 'records_stored 3' in text
+    assert 'records_sort_cache_misses 1' in text
+    assert 'records_parsed_total{format="csv"} 1' in text
+    assert 'records_parsed_total{format="psv"} 1' in text
+    assert 'records_parse_errors_total{source="api"} 1' in text
+    assert 'records_parse_errors_total{source="bulk"} 1' in text
+    assert [line for line in text.splitlines() if line.startswith('records_sort_seconds_count')] == \
+        ['records_sort_seconds_count{sort="3,DESC 4,ASC"} 1']
+    assert 'records_http_request_duration_seconds_count{method="other",route="/records",status="405"} 1' in text
+    assert 'records_http_request_duration_seconds_count{method="POST",route="/records",status="201"} 1' in text
+    assert 'records_http_request_duration_seconds_bucket{method="GET",route="/records",status="200",le="+Inf"} 20' \
+        in text
+
+
+def test_records_module_serves_app():
+    """The records module still serves the API's names for `uvicorn records:app`, importing them on first access."""
+    assert records.app is api.app
+    assert records.web_records is api.web_records
+    with pytest.raises(AttributeError):
+        records.not_an_api_name
@@ -1,5 +1,7 @@
 """CLI Tests."""
 import io
+import subprocess
+import sys
 import tempfile
 from os import unlink
 from pathlib import Path
@@ -7,6 +9,12 @@ from pathlib import Path
 import pytest
 
 import records
+from domain import metrics
+from domain.external_sort import memory_size
+from domain.incremental import update_sorted_output
+from domain.record import iter_records, read_records, sort_records
+from models.binary import COLUMN_LAYOUT, ROW_LAYOUT, write_binary_records
+from models.record import Record
 
 
 def test_process_records_file():
@@ -79,3 +87,222 @@ def test_process_records_bad_output_format():
     """Test error handling on bad output formats."""
     with pytest.raises(ValueError):
         records.process_records([str(Path(__file__).parent / 'data' / 'test.ssv')], ['0,DESC', '4,ASC'], 'tsv')
+
+
+def test_process_records_max_memory(monkeypatch):
+    """External sort spills many tiny runs, merges them in several passes, and matches the in-memory output."""
+    monkeypatch.setattr('domain.external_sort.MERGE_FAN_IN', 3)
+    files = [str(Path(__file__).parent / 'data' / name) for name in ['test.csv', 'test.psv', 'test.ssv']]
+    for sort in [['0,ASC'], ['0,DESC', '4,ASC'], ['3,ASC', '1,DESC'], None]:
+        in_memory, external = io.StringIO(), io.StringIO()
+        records.process_records(files, sort, 'psv', in_memory)
+        with tempfile.TemporaryDirectory() as spill_dir:
+            records.process_records(files, sort, 'psv', external, max_memory=2000, spill_dir=spill_dir)
+        assert external.getvalue() == in_memory.getvalue()
+
+
+@pytest.mark.parametrize('options', [{}, {'sort': ['0,ASC']}, {'sort': ['3,DESC', '0,ASC'], 'limit': 3},
+                                     {'sort': ['0,ASC'], 'max_memory': 2000}, {'sort': ['0,ASC'], 'jobs': 2}])
+def test_process_records_metrics(options, tmpdir):
+    """Every way of reading files counts the records parsed and the files skipped, and every way of sorting is timed."""
+    malformed = Path(tmpdir / 'malformed.csv')
+    malformed.write_text('a,b,c,d,1/1/2000\nnot,enough,columns\n', encoding='utf-8')
+    file = str(Path(__file__).parent / 'data' / 'test.csv')
+    sort = options.pop('sort', None)
+    metrics.enable()
+    try:
+        records.process_records([str(malformed), file], sort, 'csv', io.StringIO(), **options)
+        summary = metrics.summary().splitlines()
+    finally:
+        metrics.reset()
+    assert f'records_parsed_total{{format="csv"}} {len(read_records([file]))}' in summary
+    assert 'records_parse_errors_total{source="file"} 1' in summary
+    assert any(line.startswith('records_sort_seconds') for line in summary) == bool(sort)
+
+
+def test_process_records_max_memory_skips_bad_file():
+    """A file failing after some of its records were spilled is still skipped entirely."""
+    with tempfile.NamedTemporaryFile('w', suffix=".csv", delete=False) as tmp_file:
+        tmp_file.write('a,b,c,d,1/1/2000\n' * 20 + 'a,b,c,d,not a date\n')
+    str_io = io.StringIO()
+    good_file = str(Path(__file__).parent / 'data' / 'test.csv')
+    records.process_records([tmp_file.name, good_file], ['0,ASC'], 'csv', str_io, max_memory=2000)
+    unlink(tmp_file.name)
+
+    expected = io.StringIO()
+    records.process_records([good_file], ['0,ASC'], 'csv', expected)
+    assert str_io.getvalue() == expected.getvalue()
+
+
+def test_process_records_limit():
+    """A limit outputs the first records of the full sort, skipping bad files entirely, however records are read."""
+    with tempfile.NamedTemporaryFile('w', suffix=".csv", delete=False) as tmp_file:
+        tmp_file.write('a,b,c,d,1/1/2000\n' * 20 + 'a,b,c,d,not a date\n')
+    files = [str(Path(__file__).parent / 'data' / name) for name in ['test.csv', 'test.psv', 'test.ssv']]
+    files.insert(1, tmp_file.name)
+
+    for sort in (['3,DESC', '0,ASC'], ['4,DESC'], None):
+        full = io.StringIO()
+        records.process_records(files, sort, 'csv', full, jobs=2)
+        expected = ''.join(full.getvalue().splitlines(keepends=True)[:7])
+        for options in ({}, {'jobs': 2}, {'max_memory': 2000}):
+            limited = io.StringIO()
+            records.process_records(files, sort, 'csv', limited, limit=7, **options)
+            assert limited.getvalue() == expected, (sort, options)
+    unlink(tmp_file.name)
+
+
+def test_memory_size():
+    """Memory sizes accept plain bytes and K/M/G suffixes."""
+    assert memory_size('65536') == 65536
+    assert memory_size('512M') == 512 * 1024 ** 2
+    assert memory_size('2g') == 2 * 1024 ** 3
+    with pytest.raises(ValueError):
+        memory_size('lots')
+
+
+def test_process_records_jobs(monkeypatch):
+    """Parallel parsing, with files split into many ranges, gives the same output and skips bad files entirely."""
+    monkeypatch.setattr('domain.record.PARALLEL_SPLIT_BYTES', 200)
+    with tempfile.NamedTemporaryFile('w', suffix=".csv", delete=False) as tmp_file:
+        tmp_file.write('a,b,c,d,1/1/2000\n' * 20 + 'a,b,c,d,not a date\n')
+    files = [str(Path(__file__).parent / 'data' / name) for name in ['test.csv', 'test.psv', 'test.ssv']]
+    files.insert(1, tmp_file.name)
+
+    serial, parallel = io.StringIO(), io.StringIO()
+    records.process_records(files, ['3,DESC'], 'csv', serial)
+    records.process_records(files, ['3,DESC'], 'csv', parallel, jobs=3)
+    unlink(tmp_file.name)
+    assert parallel.getvalue() == serial.getvalue()
+    assert 'not a date' not in parallel.getvalue() and 'a,b,c,d' not in parallel.getvalue()
+
+
+def test_process_records_unsorted_streams():
+    """Unsorted runs stream every file in order, converting formats."""
+    files = [str(Path(__file__).parent / 'data' / name) for name in ['test.csv', 'test.psv', 'test.ssv']]
+    str_io = io.StringIO()
+    records.process_records(files, None, 'ssv', str_io)
+
+    expected = io.StringIO()
+    records.process_records(files, [], 'ssv', expected, jobs=2)
+    assert str_io.getvalue() == expected.getvalue()
+    assert len(str_io.getvalue().splitlines()) == 61
+
+
+def test_iter_records_skips_malformed_files(tmpdir):
+    """A file with a bad row or date part way through is skipped whole, as when sorting, and files are read in turn."""
+    malformed, valid = Path(tmpdir / 'malformed.csv'), Path(tmpdir / 'valid.csv')
+    malformed.write_text('a,b,c,d,1/1/2000\nnot,enough,columns\ne,f,g,h,1/2/2000\n', encoding='utf-8')
+    valid.write_text('i,j,k,l,1/3/2000\n', encoding='utf-8')
+    iterator = iter_records([str(malformed), str(valid), 'non-existent.csv'])
+    assert next(iterator).as_list() == ['i', 'j', 'k', 'l', '01/03/2000']
+    with pytest.raises(FileNotFoundError):
+        next(iterator)
+
+    overflowing = Path(tmpdir / 'overflowing.csv')
+    overflowing.write_text('a,b,c,d,1/1/2000\ne,f,g,h,99999999999999999999\n', encoding='utf-8')
+    for sort in (None, ['0,ASC']):
+        str_io = io.StringIO()
+        records.process_records([str(overflowing), str(valid)], sort, 'csv', str_io)
+        assert str_io.getvalue().splitlines() == ['i,j,k,l,01/03/2000']
+
+    unsorted, in_parallel = io.StringIO(), io.StringIO()
+    records.process_records([str(malformed), str(valid)], None, 'csv', unsorted)
+    records.process_records([str(malformed), str(valid)], None, 'csv', in_parallel, jobs=2)
+    assert unsorted.getvalue() == in_parallel.getvalue()
+    assert unsorted.getvalue().splitlines() == ['i,j,k,l,01/03/2000']
+
+
+@pytest.mark.parametrize('layout', [ROW_LAYOUT, COLUMN_LAYOUT])
+def test_process_records_binary_round_trip(layout, tmpdir):
+    """Text records written as binary records read back identically, in both layouts."""
+    files = [str(Path(__file__).parent / 'data' / name) for name in ['test.csv', 'test.psv', 'test.ssv']]
+    odd = Record('nul\0value', 'ünïcode', 'a,"b"|c', '', '1/1/0001')
+    binary_file = str(tmpdir / 'records.rbf')
+    with open(binary_file, 'wb') as out_stream:
+        write_binary_records(read_records(files) + [odd], out_stream, layout)
+
+    assert read_records([binary_file]) == read_records(files) + [odd]
+
+
+def test_process_records_binary_output(tmpdir):
+    """Binary output can be read back as input, and truncated binary files are skipped."""
+    file = str(Path(__file__).parent / 'data' / 'test.csv')
+    bytes_io = io.BytesIO()
+    records.process_records([file], ['4,ASC'], 'rbf', bytes_io)
+    binary_file = tmpdir / 'sorted.rbf'
+    binary_file.write_binary(bytes_io.getvalue())
+    truncated_file = tmpdir / 'truncated.rbf'
+    truncated_file.write_binary(bytes_io.getvalue()[:-3])
+
+    expected, str_io = io.StringIO(), io.StringIO()
+    records.process_records([file], ['4,ASC'], 'csv', expected)
+    records.process_records([str(binary_file), str(truncated_file)], None, 'csv', str_io)
+    assert str_io.getvalue() == expected.getvalue()
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'rbf'])
+def test_update_sorted_output(fmt, tmpdir):
+    """New files are merged into a sorted output, merged files are skipped, and changes rebuild the output."""
+    data = Path(__file__).parent / 'data'
+    files = [str(data / name) for name in ['test.csv', 'test.psv', 'test.ssv']]
+    output = str(tmpdir / f'sorted.{fmt}')
+    sorts = ['3,DESC', '0,ASC']
+
+    def expected(inputs, sort):
+        return sort_records(read_records(inputs), sort)
+
+    assert update_sorted_output(files[:1], sorts, fmt, output) == files[:1]
+    assert update_sorted_output(files[:2], sorts, fmt, output) == files[1:2]
+    assert read_records([output]) == expected(files[:2], sorts)
+    assert update_sorted_output(files[:2], sorts, fmt, output) == []
+    assert update_sorted_output(files, sorts, fmt, output, max_memory=1024) == files[2:]
+    assert read_records([output]) == expected(files, sorts)
+
+    # A different sort, a changed source and an output that doesn't match its manifest all rebuild from scratch
+    assert update_sorted_output(files, ['4,ASC'], fmt, output) == files
+    assert read_records([output]) == expected(files, ['4,ASC'])
+    changed = Path(tmpdir / 'changed.csv')
+    changed.write_text(Path(files[0]).read_text())
+    assert update_sorted_output(files + [str(changed)], ['4,ASC'], fmt, output) == [str(changed)]
+    changed.write_text('a,b,c,d,1/1/2000\n')
+    assert update_sorted_output(files + [str(changed)], ['4,ASC'], fmt, output) == files + [str(changed)]
+    assert read_records([output]) == expected(files + [str(changed)], ['4,ASC'])
+    Path(output).write_bytes(Path(output).read_bytes()[:-3])
+    assert update_sorted_output(files, ['4,ASC'], fmt, output) == files
+    assert read_records([output]) == expected(files, ['4,ASC'])
+
+
+def test_process_records_dedupe(tmpdir):
+    """Overlapping files are deduped by key, keeping the first or the last record, the same on every code path."""
+    first = Path(tmpdir / 'first.csv')
+    first.write_text('b,first,b@b.c,tan,1/1/2000\na,first,a@b.c,tan,1/1/2001\n')
+    second = Path(tmpdir / 'second.psv')
+    second.write_text('a|second|a@b.c|red|1/1/2002\nc|second|c@b.c|red|1/1/2003\nc|third|c@b.c|red|1/1/2004\n')
+    files = [str(first), str(second)]
+
+    def run(**kwargs):
+        str_io = io.StringIO()
+        records.process_records(files, kwargs.pop('sort', ['0,ASC']), 'psv', str_io, **kwargs)
+        return str_io.getvalue().splitlines()
+
+    assert run(dedupe='first') == ['a|first|a@b.c|tan|01/01/2001', 'b|first|b@b.c|tan|01/01/2000',
+                                   'c|second|c@b.c|red|01/01/2003']
+    assert run(dedupe='last') == ['a|second|a@b.c|red|01/01/2002', 'b|first|b@b.c|tan|01/01/2000',
+                                  'c|third|c@b.c|red|01/01/2004']
+    assert run(dedupe='first', max_memory=1) == run(dedupe='first') == run(dedupe='first', jobs=2)
+    assert run(dedupe='first', limit=2) == run(dedupe='first')[:2]
+    assert run(dedupe='last', sort=None) == ['b|first|b@b.c|tan|01/01/2000', 'a|second|a@b.c|red|01/01/2002',
+                                             'c|third|c@b.c|red|01/01/2004']
+    assert len(run(dedupe='first', key_columns=(0, 3))) == 4
+    with pytest.raises(ValueError):
+        run(dedupe='last', max_memory=1)
+
+
+def test_cli_import_stays_light():
+    """Importing the command line leaves the web stack, dateutil and NumPy unloaded, they only slow down startup."""
+    heavy = ['fastapi', 'starlette', 'pydantic', 'dateutil', 'numpy', 'concurrent.futures.process']
+    code = f'import sys, records; print(*[module for module in {heavy!r} if module in sys.modules])'
+    loaded = subprocess.run([sys.executable, '-c', code], cwd=Path(__file__).parent.parent, capture_output=True,
+                            text=True, check=True).stdout.split()
+    assert loaded == []
@@ -0,0 +1,155 @@
+"""Domain Tests."""
+import itertools
+import random
+from datetime import date
+from typing import Iterator, List
+
+import pytest
+
+from benchmarks.sort_records import legacy_sort_records
+from domain.record import dedupe_records, filter_predicate, merge_sorted_records, parse_filters, parse_key_columns, \
+    parse_sorts, sort_order, sort_records, top_records
+from models.record import Record
+
+
+# Utility --------------------------------------------------------------------------------------------------------------
+
+def random_records(n: int, seed: int = 0):
+    """Build n Records with heavily repeated values so multi-column sorts have plenty of ties."""
+    rng = random.Random(seed)
+    names = ['Smith', 'smith', 'Lopez', 'Llast', 'alast', '$last', 'Zed']
+    colors = ['Tan', 'Aqua', 'tan', 'Gold']
+    return [Record(rng.choice(names),
+                   rng.choice(names),
+                   f'{rng.choice(names)}@{rng.choice(colors)}.com',
+                   rng.choice(colors),
+                   date.fromordinal(rng.randint(700000, 700020)).strftime('%m/%d/%Y')) for _ in range(n)]
+
+
+def all_sorts(max_width: int) -> Iterator[List[str]]:
+    """Yield every sort of 1 to max_width distinct columns, in every direction combination."""
+    for width in range(1, max_width + 1):
+        for columns in itertools.permutations(range(5), width):
+            for directions in itertools.product(['ASC', 'DESC'], repeat=width):
+                yield [f'{c},{d}' for c, d in zip(columns, directions)]
+
+
+# Tests ----------------------------------------------------------------------------------------------------------------
+
+def test_sort_records_matches_legacy_order():
+    """Every 1-3 column sort, in every direction combination, matches the per-pass reference order."""
+    records = random_records(300)
+    for sorts in all_sorts(3):
+        assert sort_records(records, sorts) == legacy_sort_records(records, sorts), sorts
+
+
+def test_numpy_engine_matches_python_engine(monkeypatch):
+    """The columnar NumPy engine gives exactly the pure Python order, NUL characters and descending strings included."""
+    pytest.importorskip('numpy')
+    records = random_records(300) + [Record('Smith\0', 'a', 'b', 'Tan', '1/1/2000'),
+                                     Record('Smith', 'a', 'b', 'Tan', '1/1/2000')]
+    # Code strings through a dict of ranks, then through numpy.unique
+    for ratio in (1, 0):
+        monkeypatch.setattr('domain.columnar.LOW_CARDINALITY_RATIO', ratio)
+        for sorts in all_sorts(2):
+            assert sort_records(records, sorts, 'numpy') == sort_records(records, sorts, 'python'), sorts
+
+
+def test_numpy_engine_falls_back_without_numpy(monkeypatch):
+    """Asking for NumPy when it isn't installed sorts in Python instead."""
+    monkeypatch.setattr('domain.columnar.numpy', None)
+    records = random_records(50)
+    assert sort_records(records, ['0,DESC', '4,ASC'], 'numpy') == legacy_sort_records(records, ['0,DESC', '4,ASC'])
+    with pytest.raises(ValueError):
+        sort_order(records, [(0, False)], 'fortran')
+
+
+def test_top_records_matches_sort_records():
+    """Selecting the first records with a bounded heap gives the same records as a full sort, ties included."""
+    records = random_records(300)
+    for sorts in all_sorts(2):
+        expected = sort_records(records, sorts)
+        for limit in (0, 1, 9, 300, 400):
+            assert top_records(iter(records), parse_sorts(sorts), limit) == expected[:limit], (sorts, limit)
+            assert sort_records(records, sorts, limit=limit) == expected[:limit], (sorts, limit)
+
+
+def test_casefold_collation_matches_legacy_order():
+    """Case-insensitive sorts match the reference order on casefolded strings, with every engine and a heap."""
+    records = random_records(300)
+    for sorts in all_sorts(2):
+        expected = legacy_sort_records(records, sorts, str.casefold)
+        for engine in ('python', 'numpy'):
+            assert sort_records(records, sorts, engine, collation='casefold') == expected, (sorts, engine)
+        assert top_records(iter(records), parse_sorts(sorts), 9, 'casefold') == expected[:9], sorts
+    with pytest.raises(ValueError):
+        sort_records(records, ['0,ASC'], collation='klingon')
+
+
+def test_records_intern_repeated_columns():
+    """Names and colors equal to another record's are the same string object, emails aren't interned."""
+    first, second = (Record(''.join(['Sm', 'ith']), 'Al', ''.join(['a@', 'b.c']), ''.join(['T', 'an']), '1/1/2000'),
+                     Record(''.join(['Smi', 'th']), 'Al', ''.join(['a', '@b.c']), ''.join(['Ta', 'n']), '1/1/2000'))
+    assert first.last_name is second.last_name and first.favorite_color is second.favorite_color
+    assert first.email is not second.email
+
+
+def test_merge_sorted_records_matches_sort_records():
+    """Merging separately sorted halves gives the order of sorting them together, ties included."""
+    records = random_records(300)
+    for sorts in (['0,ASC'], ['3,DESC', '4,DESC'], ['3,DESC', '0,ASC'], []):
+        for collation in ('ordinal', 'casefold'):
+            halves = [sort_records(half, sorts, collation=collation) for half in (records[:100], records[100:])]
+            assert list(merge_sorted_records(halves, parse_sorts(sorts), collation)) == \
+                sort_records(records, sorts, collation=collation), (sorts, collation)
+
+
+def test_dedupe_records():
+    """Records sharing key columns are dropped, keeping the first, or the last one in the first one's place."""
+    records = random_records(300)
+    names = [(r.last_name, r.first_name) for r in records]
+    first = list(dedupe_records(iter(records), (0, 1)))
+    assert [(r.last_name, r.first_name) for r in first] == list(dict.fromkeys(names))
+    latest = {}
+    for name, record in zip(names, records):
+        latest[name] = record
+    last = list(dedupe_records(records, (0, 1), 'last'))
+    assert len(last) == len(latest) and all(r is expected for r, expected in zip(last, latest.values()))
+    with pytest.raises(ValueError):
+        list(dedupe_records(records, (0,), 'middle'))
+
+
+@pytest.mark.parametrize('key', ['', '5', '2,x', '-1'])
+def test_parse_key_columns_invalid(key):
+    """Malformed key columns are rejected."""
+    with pytest.raises(ValueError):
+        parse_key_columns(key)
+
+
+def test_sort_records_no_sorts():
+    """Records are returned untouched when there is nothing to sort."""
+    records = random_records(5)
+    assert sort_records(records, None) is records
+    assert sort_records([], ['0,ASC']) == []
+
+
+@pytest.mark.parametrize('sort', ['0', '0,ASC,1', 'a,ASC', '0,UP', '5,ASC', '-1,ASC'])
+def test_parse_sorts_invalid(sort):
+    """Malformed and out of range sorts are rejected."""
+    with pytest.raises(ValueError):
+        parse_sorts([sort])
+
+
+def test_parse_sorts():
+    """Sorts are normalized to (column number, descending) pairs in priority order."""
+    assert parse_sorts(['2,desc', '0,ASC']) == [(2, True), (0, False)]
+    assert parse_sorts(['2,desc', '0,ASC', '2,ASC', '0,ASC'] * 50) == [(2, True), (0, False)]
+
+
+def test_parse_filters():
+    """Filters are normalized to (column number, operator, value) triples, values may hold commas."""
+    assert parse_filters(['0,EQ,Smith, Jr', '4,lt,1/2/1970']) == [(0, 'eq', 'Smith, Jr'), (4, 'lt', 719164)]
+    predicate = filter_predicate(parse_filters(['3,prefix,Ta', '4,ge,1/1/2000']))
+    assert predicate(Record('a', 'b', 'c', 'Tan', '1/1/2000'))
+    assert not predicate(Record('a', 'b', 'c', 'Tan', '12/31/1999'))
+    assert not predicate(Record('a', 'b', 'c', 'tan', '1/1/2000'))
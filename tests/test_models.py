@@ -0,0 +1,50 @@
+"""Model Tests."""
+import itertools
+import pickle
+
+import pytest
+from dateutil.parser import ParserError, parse
+
+from models.dates import parse_date_ordinal
+from models.record import Record
+
+
+def test_parse_date_ordinal_matches_dateutil():
+    """Fixed layout fast paths give exactly the dates dateutil would, including day / month swaps and bad dates."""
+    months, days, years = ['1', '01', '12', '13', '00'], ['1', '09', '13', '29', '31', '32'], ['2000', '1900', '0099']
+    for month, day, year in itertools.product(months, days, years):
+        for date_str in [f'{month}/{day}/{year}', f'{month}-{day}-{year}', f'{year}-{month.zfill(2)}-{day.zfill(2)}']:
+            try:
+                expected = parse(date_str).toordinal()
+            except ParserError:
+                with pytest.raises(ParserError):
+                    parse_date_ordinal(date_str)
+                continue
+            assert parse_date_ordinal(date_str) == expected, date_str
+
+
+def test_parse_date_ordinal_fallback(monkeypatch):
+    """Unusual layouts still go through dateutil, reported through on_fallback once per distinct string."""
+    fallbacks = []
+    monkeypatch.setattr('models.dates.on_fallback', lambda: fallbacks.append(None))
+    parse_date_ordinal.cache_clear()
+    assert parse_date_ordinal('apr 2, 1991') == parse('apr 2, 1991').toordinal()
+    assert parse_date_ordinal('apr 2, 1991') == parse_date_ordinal('4/2/1991')
+    assert len(fallbacks) == 1
+    assert parse_date_ordinal(' 4/2/1991') == parse('4/2/1991').toordinal()
+    with pytest.raises(ParserError):
+        parse_date_ordinal('not a date')
+
+
+def test_record_behaves_positionally():
+    """Records index, iterate, compare and pickle by their five columns."""
+    record = Record('lasty', 'mctesterson', 'l@nasa.gov', 'mahogany', 'apr 2, 1991')
+    assert list(record) == record.as_list() == ['lasty', 'mctesterson', 'l@nasa.gov', 'mahogany', '04/02/1991']
+    assert record[4] == record[-1] == record.date_of_birth == '04/02/1991'
+    assert len(record) == 5
+    assert record == Record('lasty', 'mctesterson', 'l@nasa.gov', 'mahogany', '4-2-1991')
+    assert pickle.loads(pickle.dumps(record)) == record
+
+    record.date_of_birth = '1991-04-03'
+    assert record.date_of_birth == '04/03/1991'
+    assert record.date_of_birth_as_datetime().day == 3